@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import Document, ChatSession, ChatMessage
+from .models import Document, ChatSession, ChatMessage, FileBlob
 
 admin.site.register(Document)
 admin.site.register(ChatSession)
-admin.site.register(ChatMessage)
\ No newline at end of file
+admin.site.register(ChatMessage)
+admin.site.register(FileBlob)
\ No newline at end of file
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import time
+import uuid
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+
+ADMITTED_KEY = 'llm:admitted'
+RUNNING_KEY = 'llm:running'
+
+_client = None
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL)
+    return _client
+
+
+def _reserve(key, capacity):
+    """Add a ticket to the ``key`` sorted set unless it already holds ``capacity`` live tickets.
+
+    Tickets older than ``LLM_ADMISSION_TTL`` are treated as leaked by a
+    crashed worker and dropped.
+    """
+    client = get_redis()
+    now = time.time()
+    ticket = uuid.uuid4().hex
+    pipe = client.pipeline()
+    pipe.zremrangebyscore(key, '-inf', now - settings.LLM_ADMISSION_TTL)
+    pipe.zadd(key, {ticket: now})
+    pipe.zcard(key)
+    _, _, size = pipe.execute()
+    if size > capacity:
+        client.zrem(key, ticket)
+        return None
+    return ticket
+
+
+def admit():
+    """Reserve a place for one chat answer, running or queued.
+
+    Returns a ticket to hand to ``generate_chat_response``, or ``None`` when
+    ``LLM_MAX_CONCURRENCY + LLM_MAX_QUEUE`` answers are already pending and
+    the caller should answer "busy".
+    """
+    return _reserve(ADMITTED_KEY, settings.LLM_MAX_CONCURRENCY + settings.LLM_MAX_QUEUE)
+
+
+def release(ticket):
+    get_redis().zrem(ADMITTED_KEY, ticket)
+
+
+@contextmanager
+def admitted():
+    """Reserve a place with :func:`admit` around saving and queueing a chat message.
+
+    Yields the ticket, or ``None`` when the assistant is busy. If the block
+    raises, the ticket is released, so a message that failed to save does
+    not hold a place until ``LLM_ADMISSION_TTL`` expires.
+    """
+    ticket = admit()
+    try:
+        yield ticket
+    except BaseException:
+        if ticket:
+            release(ticket)
+        raise
+
+
+@contextmanager
+def llm_slot(poll_interval=0.2):
+    """Wait until fewer than ``LLM_MAX_CONCURRENCY`` requests are talking to Ollama."""
+    while True:
+        ticket = _reserve(RUNNING_KEY, settings.LLM_MAX_CONCURRENCY)
+        if ticket:
+            break
+        time.sleep(poll_interval)
+    try:
+        yield
+    finally:
+        get_redis().zrem(RUNNING_KEY, ticket)
+
+
+def coalesce_key(*parts):
+    normalized = [' '.join(str(part).lower().split()) for part in parts]
+    return hashlib.sha256('\0'.join(normalized).encode('utf-8')).hexdigest()
+
+
+def coalesce(key, compute, poll_interval=0.2):
+    """Run ``compute`` once for concurrent callers sharing ``key``.
+
+    The first caller becomes the leader and publishes its JSON-serializable
+    result for ``LLM_COALESCE_RESULT_TTL`` seconds; followers wait for it
+    instead of computing their own. If the leader fails or takes longer than
+    ``LLM_COALESCE_TIMEOUT``, a follower falls back to computing itself.
+    """
+    client = get_redis()
+    inflight_key = f'llm:inflight:{key}'
+    result_key = f'llm:result:{key}'
+
+    cached = client.get(result_key)
+    if cached is not None:
+        return json.loads(cached)
+
+    if client.set(inflight_key, 1, nx=True, ex=settings.LLM_COALESCE_TIMEOUT):
+        try:
+            result = compute()
+            client.set(result_key, json.dumps(result), ex=settings.LLM_COALESCE_RESULT_TTL)
+            return result
+        finally:
+            client.delete(inflight_key)
+
+    deadline = time.monotonic() + settings.LLM_COALESCE_TIMEOUT
+    while True:
+        # Checked before reading the result so a leader finishing in between is not missed.
+        leader_running = client.exists(inflight_key)
+        cached = client.get(result_key)
+        if cached is not None:
+            return json.loads(cached)
+        if not leader_running or time.monotonic() >= deadline:
+            return compute()
+        time.sleep(poll_interval)
@@ -0,0 +1,38 @@
+"""Enqueue Celery tasks by name.
+
+The web tier only needs to publish messages; going through ``send_task``
+keeps it from importing ``chatbot.tasks`` and, with it, FAISS, NumPy and
+the LangChain loaders that only the worker uses.
+"""
+from celery import current_app, group
+
+
+def enqueue_document_processing(document_id):
+    return current_app.send_task('chatbot.tasks.process_document', args=[document_id])
+
+
+def enqueue_document_batches(batches):
+    """Index each list of document ids in ``batches`` with one task, all as one group."""
+    return group(
+        current_app.signature('chatbot.tasks.process_document_batch', args=[document_ids])
+        for document_ids in batches
+    ).apply_async()
+
+
+def enqueue_document_reindex(document_id):
+    return current_app.send_task('chatbot.tasks.reindex_document', args=[document_id])
+
+
+def enqueue_chat_response(session_id, message_id, ticket=None):
+    try:
+        return current_app.send_task('chatbot.tasks.generate_chat_response', args=[session_id, message_id, ticket])
+    except Exception:
+        # The task that would release the admission ticket never got queued.
+        if ticket:
+            from .admission import release
+            release(ticket)
+        raise
+
+
+def enqueue_shard_rebalance(user_id):
+    return current_app.send_task('chatbot.tasks.rebalance_vector_shards', args=[user_id])
@@ -0,0 +1,45 @@
+"""Per-session chat events over Redis pub/sub.
+
+Workers publish answer tokens and finished messages on a channel per chat
+session; the ASGI ``session_events`` view relays them to the browser as
+server-sent events, so open chat tabs no longer poll the database.
+"""
+import json
+
+from django.conf import settings
+
+from .admission import get_redis
+
+
+def session_channel(session_id):
+    return f'chat:session:{session_id}'
+
+
+def publish(session_id, event_type, **data):
+    get_redis().publish(session_channel(session_id), json.dumps({'type': event_type, **data}))
+
+
+async def stream_session_events(session_id):
+    """Yield server-sent event frames for ``session_id`` until the client goes away.
+
+    A comment frame is sent every ``CHAT_EVENTS_KEEPALIVE`` seconds of
+    silence so proxies keep the connection open.
+    """
+    import redis.asyncio
+
+    client = redis.asyncio.Redis.from_url(settings.REDIS_URL)
+    pubsub = client.pubsub()
+    await pubsub.subscribe(session_channel(session_id))
+    try:
+        yield 'retry: 3000\n\n'
+        while True:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=settings.CHAT_EVENTS_KEEPALIVE
+            )
+            if message is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield f"data: {message['data'].decode('utf-8')}\n\n"
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
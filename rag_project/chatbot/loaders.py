@@ -0,0 +1,86 @@
+from collections import defaultdict
+
+from .models import ChatMessage, Document, Embedding
+
+
+class BatchLoader:
+    """Per-request loader that resolves many keys with a single query.
+
+    Keys of sibling objects are queued as soon as their parents are fetched,
+    so the first ``load`` for any of them fetches the whole level at once.
+    """
+
+    def __init__(self, batch_load_fn, default=None):
+        self.batch_load_fn = batch_load_fn
+        self.default = default
+        self._cache = {}
+        self._pending = set()
+
+    def queue(self, keys):
+        self._pending.update(key for key in keys if key not in self._cache)
+
+    def prime(self, key, value):
+        self._cache.setdefault(key, value)
+
+    def load(self, key):
+        if key not in self._cache:
+            self._pending.add(key)
+            keys = list(self._pending)
+            self._pending.clear()
+            results = self.batch_load_fn(keys)
+            for k in keys:
+                self._cache[k] = results.get(k, self.default() if self.default else None)
+        return self._cache[key]
+
+
+class RequestLoaders:
+    """Bundle of the batch loaders used by the GraphQL schema for one request."""
+
+    def __init__(self):
+        self.session_messages = BatchLoader(self._load_session_messages, default=list)
+        self.message_references = BatchLoader(self._load_message_references, default=list)
+        self.document_embeddings = BatchLoader(self._load_document_embeddings, default=list)
+        self.documents = BatchLoader(self._load_documents)
+
+    def _load_session_messages(self, session_ids):
+        grouped = defaultdict(list)
+        for message in ChatMessage.objects.filter(session_id__in=session_ids).select_related('session'):
+            grouped[message.session_id].append(message)
+        self.message_references.queue(m.id for messages in grouped.values() for m in messages)
+        return grouped
+
+    def _load_message_references(self, message_ids):
+        through = ChatMessage.references.through
+        links = (
+            through.objects
+            .filter(chatmessage_id__in=message_ids)
+            .select_related('embedding__document')
+            .defer('embedding__embedding')
+        )
+        grouped = defaultdict(list)
+        for link in links:
+            grouped[link.chatmessage_id].append(link.embedding)
+            self.documents.prime(link.embedding.document_id, link.embedding.document)
+        self.document_embeddings.queue(
+            embedding.document_id for embeddings in grouped.values() for embedding in embeddings
+        )
+        return grouped
+
+    def _load_document_embeddings(self, document_ids):
+        grouped = defaultdict(list)
+        for embedding in Embedding.objects.filter(document_id__in=document_ids).defer('embedding'):
+            grouped[embedding.document_id].append(embedding)
+        return grouped
+
+    def _load_documents(self, document_ids):
+        return Document.objects.in_bulk(document_ids)
+
+
+def get_loaders(info):
+    """Return the loaders attached to the request, creating them on first use."""
+    context = info.context
+    loaders = getattr(context, 'loaders', None)
+    if loaders is None:
+        loaders = RequestLoaders()
+        context.loaders = loaders
+    return loaders
@@ -0,0 +1,87 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+
+from chatbot.models import Document, Embedding
+from chatbot.retrieval import PgVectorBackend
+from chatbot.vector_store import VectorSegment, load_vectors
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy vectors stored by the FAISS backend (segment files and legacy pickles) into "
+        "PgVectorBackend's table, and fill in missing index sketches. Run it after switching "
+        "RETRIEVAL_BACKEND to chatbot.retrieval.PgVectorBackend; it can be run again safely."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help="Only this user (repeatable).")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, user=None, batch_size=500, **options):
+        backend = PgVectorBackend()
+        if backend.table not in connection.introspection.table_names():
+            raise CommandError(
+                f"{backend.table} does not exist: PgVectorBackend needs PostgreSQL with pgvector, "
+                "and migration chatbot 0005 applied there."
+            )
+        user_ids = user or list(Document.objects.values_list('owner_id', flat=True).distinct())
+        for user_id in user_ids:
+            copied = self._copy_stored_vectors(backend, user_id, batch_size)
+            sketched = self._fill_sketches(backend, user_id, batch_size) if backend.sketched else 0
+            self.stdout.write(f"user {user_id}: copied {copied} vectors, sketched {sketched}")
+
+    def _missing_ids(self, backend, user_id, condition):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT e.id FROM chatbot_embedding e"
+                " JOIN chatbot_document d ON d.id = e.document_id"
+                f" LEFT JOIN {backend.table} v ON v.embedding_id = e.id"
+                f" WHERE d.owner_id = %s AND {condition} ORDER BY e.id",
+                [user_id]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def _copy_stored_vectors(self, backend, user_id, batch_size):
+        segment = VectorSegment(user_id)
+        if len(segment) and segment.projection:
+            raise CommandError(
+                f"User {user_id}'s vectors are projected (v{segment.projection}); "
+                f"run `manage.py project_vectors --to 0 --user {user_id}` first."
+            )
+        missing = self._missing_ids(backend, user_id, "v.embedding_id IS NULL")
+        copied = 0
+        # Offsets only stay valid while compaction is locked out.
+        with segment.lock:
+            for start in range(0, len(missing), batch_size):
+                rows = list(
+                    Embedding.objects.filter(id__in=missing[start:start + batch_size])
+                    .filter(Q(vector_offset__isnull=False) | Q(embedding__isnull=False))
+                    .values('id', 'vector_offset', 'embedding')
+                )
+                if not rows:
+                    continue
+                vectors = load_vectors(segment, rows)
+                try:
+                    with transaction.atomic():
+                        backend.write(user_id, [row['id'] for row in rows], vectors)
+                except ValueError as exc:
+                    raise CommandError(f"User {user_id}: {exc}")
+                copied += len(rows)
+        return copied
+
+    def _fill_sketches(self, backend, user_id, batch_size):
+        """Sketch rows written before the table had a sketch column."""
+        missing = self._missing_ids(backend, user_id, "v.embedding_id IS NOT NULL AND v.sketch IS NULL")
+        for start in range(0, len(missing), batch_size):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT embedding_id, vector::text FROM {backend.table} WHERE embedding_id = ANY(%s)",
+                    [missing[start:start + batch_size]]
+                )
+                rows = cursor.fetchall()
+            with transaction.atomic():
+                backend.write(user_id, [embedding_id for embedding_id, _ in rows], [json.loads(text) for _, text in rows])
+        return len(missing)
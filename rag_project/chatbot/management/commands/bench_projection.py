@@ -0,0 +1,92 @@
+import time
+
+import faiss
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.models import Embedding
+from chatbot.projection import KINDS, make_transform
+from chatbot.vector_store import VectorSegment
+
+from .bench_quantization import synthetic_corpus
+
+
+def embedding_like_corpus(n_vectors, dimension, n_queries, seed=0):
+    """Clustered vectors whose variance decays over a random basis, as in real embedding spaces."""
+    data, queries = synthetic_corpus(n_vectors, dimension, n_queries, seed)
+    rng = np.random.default_rng(seed + 1)
+    scales = (np.arange(1, dimension + 1, dtype='float32') ** -0.75)
+    rotation, _ = np.linalg.qr(rng.standard_normal((dimension, dimension)).astype('float32'))
+    return (data * scales) @ rotation, (queries * scales) @ rotation
+
+
+class Command(BaseCommand):
+    help = "Report recall@k lost against index memory and query time saved when projecting vectors to fewer dims."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help="Benchmark this user's stored (unprojected) vectors instead.")
+        parser.add_argument('--vectors', type=int, default=100000, help="Synthetic corpus size.")
+        parser.add_argument('--dim', type=int, default=4096, help="Synthetic vector width (mistral: 4096).")
+        parser.add_argument('--dims', default='64,128,256,512,1024', help="Comma-separated target dimensions.")
+        parser.add_argument('--kind', choices=KINDS, default='pca')
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--k', type=int, default=10)
+
+    def handle(self, *args, user=None, vectors=100000, dim=4096, dims='64,128,256,512,1024', kind='pca',
+               queries=200, k=10, **options):
+        if user is not None:
+            segment = VectorSegment(user)
+            if segment.projection:
+                raise CommandError(f"User {user}'s vectors are already projected (v{segment.projection}).")
+            offsets = list(
+                Embedding.objects.filter(document__owner_id=user, vector_offset__isnull=False)
+                .order_by('vector_offset').values_list('vector_offset', flat=True)
+            )
+            if len(offsets) <= queries:
+                raise CommandError(f"User {user} has only {len(offsets)} stored vectors.")
+            data = np.asarray(segment.take(offsets), dtype='float32')
+            rng = np.random.default_rng(0)
+            query_rows = rng.choice(len(data), queries, replace=False)
+            query_vectors = data[query_rows] + 0.01 * rng.standard_normal((queries, data.shape[1])).astype('float32')
+        else:
+            data, query_vectors = embedding_like_corpus(vectors, dim, queries)
+        data = np.ascontiguousarray(data, dtype='float32')
+        query_vectors = np.ascontiguousarray(query_vectors, dtype='float32')
+
+        targets = sorted(int(d) for d in dims.split(',') if 0 < int(d) < data.shape[1])
+        rng = np.random.default_rng(0)
+        sample = data[rng.choice(len(data), min(len(data), settings.VECTOR_PROJECTION_TRAIN_SAMPLE), replace=False)]
+
+        self.stdout.write(
+            f"{len(data)} vectors x {data.shape[1]} dims, {queries} queries, k={k}, {kind} trained on "
+            f"{len(sample)} vectors; recall against exact search on the full vectors"
+        )
+        self.stdout.write(
+            f"{'dims':<8}{'train s':>10}{'index MB':>10}{'query ms':>10}{'speedup':>10}{'recall@k':>10}"
+        )
+        truth, baseline_ms = self._search(data, query_vectors, k)
+        self._row(data.shape[1], 0.0, data, baseline_ms, baseline_ms, 1.0)
+        for target in targets:
+            transform = make_transform(kind, data.shape[1], target)
+            started = time.perf_counter()
+            transform.train(sample)
+            train_seconds = time.perf_counter() - started
+            projected = transform.apply(data)
+            found, query_ms = self._search(projected, transform.apply(query_vectors), k)
+            recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+            self._row(target, train_seconds, projected, query_ms, baseline_ms, recall)
+
+    def _search(self, data, query_vectors, k):
+        """Exact top-k positions per query and the mean latency of a one-query search."""
+        index = faiss.IndexFlatL2(data.shape[1])
+        index.add(data)
+        started = time.perf_counter()
+        found = [index.search(query[None, :], k)[1][0] for query in query_vectors]
+        return found, (time.perf_counter() - started) * 1000 / len(query_vectors)
+
+    def _row(self, dims, train_seconds, data, query_ms, baseline_ms, recall):
+        self.stdout.write(
+            f"{dims:<8}{train_seconds:>10.1f}{data.nbytes / 2 ** 20:>10.1f}{query_ms:>10.2f}"
+            f"{baseline_ms / query_ms:>9.1f}x{recall:>10.3f}"
+        )
@@ -0,0 +1,97 @@
+import time
+
+import faiss
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.models import Embedding
+from chatbot.quantization import build_index
+from chatbot.vector_store import VectorSegment
+
+
+def synthetic_corpus(n_vectors, dimension, n_queries, seed=0):
+    """Clustered Gaussian vectors; the queries are held-out points from the same clusters."""
+    rng = np.random.default_rng(seed)
+    total = n_vectors + n_queries
+    centers = rng.standard_normal((256, dimension)).astype('float32')
+    labels = rng.integers(0, len(centers), total)
+    spread = rng.uniform(0.5, 1.5, (total, 1)).astype('float32')
+    points = centers[labels] + spread * rng.standard_normal((total, dimension)).astype('float32')
+    return points[:n_vectors], points[n_vectors:]
+
+
+class Command(BaseCommand):
+    help = "Report index memory, recall@k and query latency for the flat, int8 and PQ vector representations."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help="Benchmark this user's stored vectors instead of a synthetic corpus.")
+        parser.add_argument('--vectors', type=int, default=100000, help="Synthetic corpus size.")
+        parser.add_argument('--dim', type=int, default=4096, help="Synthetic vector width (mistral: 4096).")
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--k', type=int, default=10)
+
+    def handle(self, *args, user=None, vectors=100000, dim=4096, queries=200, k=10, **options):
+        if user is not None:
+            offsets = list(
+                Embedding.objects.filter(document__owner_id=user, vector_offset__isnull=False)
+                .order_by('vector_offset').values_list('vector_offset', flat=True)
+            )
+            if len(offsets) <= queries:
+                raise CommandError(f"User {user} has only {len(offsets)} stored vectors.")
+            data = np.asarray(VectorSegment(user).take(offsets), dtype='float32')
+            rng = np.random.default_rng(0)
+            query_rows = rng.choice(len(data), queries, replace=False)
+            query_vectors = data[query_rows] + 0.01 * rng.standard_normal((queries, data.shape[1])).astype('float32')
+        else:
+            data, query_vectors = synthetic_corpus(vectors, dim, queries)
+
+        exact = faiss.IndexFlatL2(data.shape[1])
+        exact.add(data)
+        _, truth = exact.search(query_vectors, k)
+
+        self.stdout.write(
+            f"{len(data)} vectors x {data.shape[1]} dims, {queries} queries, k={k}, "
+            f"rerank factor {settings.VECTOR_RERANK_FACTOR}, nprobe {settings.VECTOR_INDEX_NPROBE}"
+        )
+        self.stdout.write(
+            f"{'mode':<10}{'index MB':>10}{'build s':>10}{'query ms':>10}{'recall@k':>10}{'no rescore':>12}"
+        )
+        for mode in ('flat', 'sq8', 'pq'):
+            started = time.perf_counter()
+            if mode == 'flat':
+                # What FaissBackend builds per query for small corpora.
+                nlist = min(100, max(1, int(len(data) ** 0.5)))
+                index = faiss.IndexIVFFlat(faiss.IndexFlatL2(data.shape[1]), data.shape[1], nlist, faiss.METRIC_L2)
+                index.train(data)
+                index.add(data)
+            else:
+                index = build_index(data, mode)
+            build_seconds = time.perf_counter() - started
+            index.nprobe = settings.VECTOR_INDEX_NPROBE
+
+            started = time.perf_counter()
+            found = [self._search(index, data, query, k, rerank=mode != 'flat') for query in query_vectors]
+            query_ms = (time.perf_counter() - started) * 1000 / queries
+
+            _, unscored = index.search(query_vectors, k)
+
+            recall = self._recall(found, truth, k)
+            unscored_recall = self._recall(unscored, truth, k)
+            index_mb = faiss.serialize_index(index).nbytes / 2 ** 20
+            self.stdout.write(
+                f"{mode:<10}{index_mb:>10.1f}{build_seconds:>10.1f}{query_ms:>10.2f}"
+                f"{recall:>10.3f}{unscored_recall:>12.3f}"
+            )
+
+    def _recall(self, found, truth, k):
+        return np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+
+    def _search(self, index, data, query, k, rerank):
+        n_candidates = k * settings.VECTOR_RERANK_FACTOR if rerank else k
+        _, positions = index.search(query[None, :], n_candidates)
+        positions = positions[0][positions[0] >= 0]
+        if not rerank:
+            return positions[:k].tolist()
+        distances = ((data[positions] - query) ** 2).sum(axis=1)
+        return positions[np.argsort(distances)[:k]].tolist()
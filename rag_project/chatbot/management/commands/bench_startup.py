@@ -0,0 +1,76 @@
+import json
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Worker-only dependencies the web tier must never import.
+HEAVY_MODULES = [
+    'faiss', 'numpy', 'torch', 'pypdf', 'docx2txt',
+    'langchain_core', 'langchain_community', 'langchain_ollama', 'langchain_text_splitters',
+]
+
+# Each probe runs in a fresh interpreter and reports its own timing and peak RSS.
+PROBE = """
+import json, os, resource, sys, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rag_project.settings')
+started = time.perf_counter()
+{body}
+print(json.dumps({{
+    'seconds': time.perf_counter() - started,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': sorted({{name.split('.')[0] for name in sys.modules}}),
+}}))
+"""
+
+TARGETS = {
+    'manage.py check': (
+        "from django.core.management import execute_from_command_line\n"
+        "execute_from_command_line(['manage.py', 'check'])"
+    ),
+    'WSGI application': (
+        "from rag_project.wsgi import application\n"
+        "from django.urls import get_resolver\n"
+        "get_resolver().url_patterns"
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = "Measure web-tier startup time and memory, and fail if worker-only dependencies get imported."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per target; the best run is reported.")
+        parser.add_argument('--max-seconds', type=float, help="Fail if a target takes longer than this.")
+        parser.add_argument('--max-rss-mb', type=float, help="Fail if a target's peak RSS exceeds this.")
+
+    def handle(self, *args, repeat=3, max_seconds=None, max_rss_mb=None, **options):
+        failures = []
+        for name, body in TARGETS.items():
+            runs = [self._probe(body) for _ in range(repeat)]
+            seconds = min(run['seconds'] for run in runs)
+            rss_mb = min(run['max_rss_kb'] for run in runs) / 1024
+            heavy = sorted(set(HEAVY_MODULES) & set(runs[0]['modules']))
+            self.stdout.write(f"{name}: {seconds:.2f}s, {rss_mb:.0f} MB peak RSS, {len(runs[0]['modules'])} top-level modules")
+
+            if heavy:
+                failures.append(f"{name} imported worker-only modules: {', '.join(heavy)}")
+            if max_seconds is not None and seconds > max_seconds:
+                failures.append(f"{name} took {seconds:.2f}s (limit {max_seconds}s)")
+            if max_rss_mb is not None and rss_mb > max_rss_mb:
+                failures.append(f"{name} used {rss_mb:.0f} MB (limit {max_rss_mb} MB)")
+
+        if failures:
+            raise CommandError("\n".join(failures))
+
+    def _probe(self, body):
+        result = subprocess.run(
+            [sys.executable, '-c', PROBE.format(body=body)],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise CommandError(result.stderr)
+        return json.loads(result.stdout.strip().splitlines()[-1])
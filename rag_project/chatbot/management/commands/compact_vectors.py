@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from chatbot.models import Document
+from chatbot.vector_store import compact_user_vectors
+
+
+class Command(BaseCommand):
+    help = "Compact users' vector segments and move legacy pickled vectors out of the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users', help="Only compact this user id (repeatable).")
+        parser.add_argument('--force', action='store_true', help="Compact even below VECTOR_COMPACTION_DEAD_RATIO.")
+
+    def handle(self, *args, users=None, force=False, **options):
+        if not users:
+            users = Document.objects.values_list('owner_id', flat=True).distinct()
+        for user_id in users:
+            reclaimed = compact_user_vectors(user_id, force=force)
+            self.stdout.write(f"User {user_id}: reclaimed {reclaimed} rows")
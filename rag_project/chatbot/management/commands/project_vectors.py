@@ -0,0 +1,122 @@
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.models import Document, Embedding
+from chatbot.projection import KINDS, Projection, available_versions, project
+from chatbot.vector_store import VectorSegment, compact_user_vectors
+
+
+class Command(BaseCommand):
+    help = (
+        "Train a dimensionality-reducing projection of the stored embeddings and/or "
+        "re-project users' vector segments to a projection version."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--train', choices=KINDS, help="Train a new projection version of this kind.")
+        parser.add_argument('--dim', type=int, default=256, help="Target dimension when training.")
+        parser.add_argument(
+            '--to', type=int, dest='target',
+            help="Projection version to move segments to (default: VECTOR_PROJECTION_VERSION, "
+                 "or the version just trained). 0 goes back to raw embeddings."
+        )
+        parser.add_argument('--user', type=int, action='append', help="Only this user (repeatable).")
+        parser.add_argument('--dry-run', action='store_true', help="Only report which segments would change.")
+
+    def handle(self, *args, train=None, dim=256, target=None, user=None, dry_run=False, **options):
+        user_ids = user or list(Document.objects.values_list('owner_id', flat=True).distinct())
+
+        if train:
+            try:
+                projection = Projection.train(self._training_sample(user_ids), train, dim)
+            except ValueError as exc:
+                raise CommandError(str(exc))
+            self.stdout.write(
+                f"Trained projection v{projection.version}: {train} {projection.d_in} -> {projection.d_out} dims "
+                f"on {projection.meta['trained_on']} vectors. Set VECTOR_PROJECTION_VERSION={projection.version} "
+                f"so new segments use it."
+            )
+            if target is None:
+                target = projection.version
+        if target is None:
+            target = settings.VECTOR_PROJECTION_VERSION
+        if target and target not in available_versions():
+            raise CommandError(f"Projection v{target} does not exist (available: {available_versions()}).")
+
+        for user_id in user_ids:
+            self._migrate(user_id, target, dry_run)
+
+    def _training_sample(self, user_ids):
+        """Sample the raw vectors of live embeddings in unprojected segments, proportionally to their number."""
+        counts = {}
+        for user_id in user_ids:
+            segment = VectorSegment(user_id)
+            if len(segment) and segment.projection == 0:
+                counts[user_id] = self._live_offsets(user_id).count()
+        total = sum(counts.values())
+        if not total:
+            raise CommandError("No unprojected vectors to train on.")
+
+        rng = np.random.default_rng(0)
+        share = min(1.0, settings.VECTOR_PROJECTION_TRAIN_SAMPLE / total)
+        sample = []
+        for user_id in counts:
+            segment = VectorSegment(user_id)
+            # Offsets only stay valid while compaction is locked out.
+            with segment.lock:
+                offsets = list(self._live_offsets(user_id))
+                if not offsets:
+                    continue
+                size = max(1, int(len(offsets) * share))
+                chosen = np.sort(rng.choice(offsets, size, replace=False)).tolist()
+                sample.append(np.array(segment.take(chosen), dtype='float32'))
+        if not sample:
+            raise CommandError("No unprojected vectors to train on.")
+        return np.concatenate(sample)
+
+    def _live_offsets(self, user_id):
+        return (
+            Embedding.objects.filter(document__owner_id=user_id, vector_offset__isnull=False)
+            .values_list('vector_offset', flat=True)
+        )
+
+    def _migrate(self, user_id, target, dry_run):
+        segment = VectorSegment(user_id)
+        if not len(segment) or segment.projection == target:
+            return
+        source = segment.projection
+        if dry_run:
+            self.stdout.write(f"user {user_id}: v{source} -> v{target}, {len(segment)} rows")
+            return
+
+        # Moves legacy pickled vectors in and drops dead rows, so every live row is in the segment.
+        compact_user_vectors(user_id, force=True)
+        with segment.lock:
+            live = list(
+                Embedding.objects.filter(document__owner_id=user_id, vector_offset__isnull=False)
+                .order_by('vector_offset')
+                .values_list('id', 'vector_offset')
+            )
+            if not live:
+                segment.path.unlink(missing_ok=True)
+                return
+
+            if source == 0:
+                def transform(offsets, rows):
+                    return project(rows, target)
+            else:
+                # Projected rows cannot be mapped to another projection; embed the text again.
+                from langchain_ollama import OllamaEmbeddings
+                embeddings_model = OllamaEmbeddings(model="mistral")
+                texts = dict(
+                    Embedding.objects.filter(document__owner_id=user_id, vector_offset__isnull=False)
+                    .values_list('vector_offset', 'text_chunk')
+                )
+
+                def transform(offsets, rows):
+                    return project(embeddings_model.embed_documents([texts[offset] for offset in offsets]), target)
+
+            remap = segment.write_compacted([offset for _, offset in live], transform, projection=target)
+            segment.commit_compacted([(emb_id, remap[offset]) for emb_id, offset in live])
+        self.stdout.write(f"user {user_id}: re-projected {len(live)} vectors from v{source} to v{target}")
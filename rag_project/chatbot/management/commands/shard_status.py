@@ -0,0 +1,91 @@
+import time
+from functools import partial
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.models import Document
+from chatbot.projection import load_projection
+from chatbot.retrieval import FaissBackend, get_backend, searchable_chunks
+from chatbot.sharding import ShardedFaissBackend, rebalance_shards, shard_loads, shard_queue
+from chatbot.vector_store import VectorSegment
+
+
+class Command(BaseCommand):
+    help = "Show how users' documents are spread over retrieval shards, and check fan-out search against a local search."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help="Only this user (repeatable).")
+        parser.add_argument('--rebalance', action='store_true', help="Rebalance before reporting.")
+        parser.add_argument(
+            '--verify', type=int, default=0, metavar='N',
+            help="Run N queries through the shard workers and compare them with an in-process search."
+        )
+        parser.add_argument('--k', type=int, default=10)
+
+    def handle(self, *args, user=None, rebalance=False, verify=0, k=10, **options):
+        backend = get_backend()
+        if not isinstance(backend, ShardedFaissBackend):
+            raise CommandError("RETRIEVAL_BACKEND is not chatbot.sharding.ShardedFaissBackend.")
+
+        user_ids = user or Document.objects.values_list('owner_id', flat=True).distinct()
+        for user_id in user_ids:
+            if rebalance:
+                self.stdout.write(f"user {user_id}: moved {rebalance_shards(user_id)} documents")
+            loads, _ = shard_loads(user_id)
+            unassigned = Document.objects.filter(owner_id=user_id).exclude(shard__in=list(loads)).count()
+            spread = ", ".join(f"{shard_queue(shard)}={load}" for shard, load in loads.items())
+            self.stdout.write(f"user {user_id}: {spread}, {unassigned} unassigned documents")
+            if verify:
+                self._verify(backend, get_user_model().objects.get(pk=user_id), verify, k)
+
+    def _verify(self, backend, user, n_queries, k):
+        live = np.array(searchable_chunks(user).values_list('id', 'vector_offset'), dtype='float64')
+        if not len(live) or np.isnan(live).any():
+            self.stdout.write("  nothing to verify (no segment vectors, or legacy vectors not compacted yet)")
+            return
+        ids, offsets = live[:, 0].astype('int64'), live[:, 1].astype('int64')
+        segment = VectorSegment(user.pk)
+        vectors = segment.vectors()
+        rng = np.random.default_rng(0)
+        queries = np.array(vectors[rng.choice(offsets, min(n_queries, len(offsets)), replace=False)], dtype='float32')
+        queries += 0.01 * rng.standard_normal(queries.shape).astype('float32')
+        truth = self._exact_top_k(vectors, ids, offsets, queries, k)
+        if segment.projection:
+            # The backends expect raw embeddings and project them again.
+            queries = load_projection(segment.projection).reverse(queries)
+
+        found = {'sharded': [], 'local': []}
+        seconds = {'sharded': 0.0, 'local': 0.0}
+        for query, expected in zip(queries, truth):
+            for name, search in (('sharded', backend.search), ('local', partial(FaissBackend.search, backend))):
+                started = time.perf_counter()
+                rows = search(user, query, k)
+                seconds[name] += time.perf_counter() - started
+                found[name].append(len({row['id'] for row in rows} & expected) / k)
+
+        self.stdout.write(
+            f"  {len(queries)} queries over {settings.VECTOR_SHARDS} shards, recall@{k} against exact search: "
+            + ", ".join(
+                f"{name} {np.mean(found[name]):.3f} ({seconds[name] * 1000 / len(queries):.1f} ms/query)"
+                for name in found
+            )
+        )
+
+    def _exact_top_k(self, vectors, ids, offsets, queries, k, batch_size=65536):
+        """Brute-force top-k ids per query, reading the segment in batches."""
+        best_distances = np.full((len(queries), 0), np.inf, dtype='float32')
+        best_ids = np.empty((len(queries), 0), dtype='int64')
+        for start in range(0, len(offsets), batch_size):
+            batch = np.asarray(vectors[offsets[start:start + batch_size]], dtype='float32')
+            distances = (
+                (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ batch.T + (batch ** 2).sum(axis=1)[None, :]
+            )
+            best_distances = np.hstack([best_distances, distances])
+            best_ids = np.hstack([best_ids, np.broadcast_to(ids[start:start + batch_size], distances.shape)])
+            keep = np.argsort(best_distances, axis=1)[:, :k]
+            best_distances = np.take_along_axis(best_distances, keep, axis=1)
+            best_ids = np.take_along_axis(best_ids, keep, axis=1)
+        return [set(row.tolist()) for row in best_ids]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-19 18:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='embedding',
+            name='vector_offset',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='embedding',
+            name='embedding',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
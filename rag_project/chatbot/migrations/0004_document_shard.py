@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-19 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0003_fileblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='shard',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.db import migrations
+
+TABLE = 'chatbot_embedding_vector'
+
+
+def create_vector_table(apps, schema_editor):
+    """Create PgVectorBackend's vector table, on PostgreSQL servers that have pgvector.
+
+    Column widths come from PGVECTOR_DIMENSIONS / PGVECTOR_INDEX_DIMENSIONS when the
+    migration runs; to change them, migrate back to 0004 and forward again, then run
+    `manage.py backfill_pgvector`.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'vector'")
+        if cursor.fetchone() is None:
+            print(f"pgvector is not installed on this server; skipping {TABLE}.")
+            return
+
+    dimensions = settings.PGVECTOR_DIMENSIONS
+    index_dimensions = min(dimensions, settings.PGVECTOR_INDEX_DIMENSIONS)
+    # HNSW indexes at most 2000 dimensions; wider vectors are indexed through a sketch column.
+    index_column = 'vector' if index_dimensions == dimensions else 'sketch'
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    # IF NOT EXISTS: deployments that already used PgVectorBackend created the table on first use.
+    schema_editor.execute(
+        f"CREATE TABLE IF NOT EXISTS {TABLE} ("
+        " embedding_id bigint PRIMARY KEY"
+        "  REFERENCES chatbot_embedding (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,"
+        " owner_id bigint NOT NULL,"
+        f" vector vector({dimensions}) NOT NULL)"
+    )
+    if index_column == 'sketch':
+        # Filled in for existing rows by `manage.py backfill_pgvector`.
+        schema_editor.execute(f"ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS sketch vector({index_dimensions})")
+    schema_editor.execute(f"CREATE INDEX IF NOT EXISTS {TABLE}_owner_idx ON {TABLE} (owner_id)")
+    schema_editor.execute(
+        f"CREATE INDEX IF NOT EXISTS {TABLE}_hnsw_idx ON {TABLE} USING hnsw ({index_column} vector_l2_ops)"
+        f" WITH (m = {settings.PGVECTOR_HNSW_M}, ef_construction = {settings.PGVECTOR_HNSW_EF_CONSTRUCTION})"
+    )
+
+
+def drop_vector_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0004_document_shard'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_vector_table, drop_vector_table),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-19 20:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chatbot', '0005_embedding_vector_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VectorSegmentState',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('generation', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -1,17 +1,88 @@
 import pickle
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.core.exceptions import ValidationError
 from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .storage import ContentAddressedStorage, sha256_from_name
 
 User = get_user_model()
 
+class FileBlob(models.Model):
+    """A file in content-addressed storage, shared by every Document with the same content.
+
+    ``ref_count`` is the number of documents pointing at the file; it is
+    deleted from storage when that drops to zero. ``chunks`` caches the
+    split text so identical uploads are parsed only once.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    split_version = models.CharField(max_length=64, blank=True)
+    chunks = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def acquire(cls, name, size):
+        """Record one more document using the stored file ``name``.
+
+        The updated row stays locked until the caller's transaction ends, so
+        a concurrent :meth:`release` cannot delete the file in the meantime.
+        """
+        sha256 = sha256_from_name(name)
+        if sha256 is None:
+            return
+        while True:
+            blob, created = cls.objects.get_or_create(name=name, defaults={'sha256': sha256, 'size': size})
+            if cls.objects.filter(pk=blob.pk).update(ref_count=models.F('ref_count') + 1):
+                return
+            # _delete_if_unused removed the row after get_or_create found it; create it again.
+
+    @classmethod
+    def release(cls, name):
+        """Drop one reference to ``name``, deleting the file once nothing uses it.
+
+        Files stored before content addressing are not shared and are deleted
+        straight away.
+        """
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().filter(name=name).first()
+            if blob is None:
+                if sha256_from_name(name) is None:
+                    storage = Document._meta.get_field('file').storage
+                    transaction.on_commit(lambda: storage.delete(name))
+                return
+            if blob.ref_count > 0:
+                cls.objects.filter(pk=blob.pk).update(ref_count=models.F('ref_count') - 1)
+            if blob.ref_count <= 1:
+                transaction.on_commit(lambda: cls._delete_if_unused(name))
+
+    @classmethod
+    def _delete_if_unused(cls, name):
+        # Under the row lock: an identical upload either took its reference first and keeps
+        # the file, or waits for this to commit and then stores the file again.
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().filter(name=name, ref_count=0).first()
+            if blob is not None:
+                blob.delete()
+                Document._meta.get_field('file').storage.delete(name)
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} references)"
+
+
 class Document(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='documents')
     title = models.CharField(max_length=255)
-    file = models.FileField(upload_to='documents/')
+    file = models.FileField(upload_to='documents/', storage=ContentAddressedStorage())
     file_type = models.CharField(max_length=10, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     processed = models.BooleanField(default=False)
+    # Retrieval shard holding this document's vectors when sharding is enabled.
+    shard = models.PositiveSmallIntegerField(null=True, blank=True)
 
     def clean(self):
         """Validate file type before saving"""
@@ -21,33 +92,101 @@ class Document(models.Model):
             raise ValidationError(f'Unsupported file extension. Allowed: {", ".join(valid_extensions)}')
         self.file_type = ext
 
+    # The file name this instance was loaded or last saved with; None for new documents.
+    _loaded_file_name = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'file' in field_names:
+            instance._loaded_file_name = values[field_names.index('file')] or None
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using, fields, from_queryset)
+        if fields is None or 'file' in fields:
+            self._loaded_file_name = self.file.name or None
+
     def save(self, *args, **kwargs):
         is_new = self.pk is None  
         self.full_clean()
-        super().save(*args, **kwargs)
+        storing_file = bool(self.file) and not self.file._committed
+        assigned_file = storing_file or (self.file.name or None) != self._loaded_file_name
+        update_fields = kwargs.get('update_fields')
+        saving_file = update_fields is None or 'file' in update_fields
+        with transaction.atomic():
+            previous_name = None
+            if not is_new and saving_file:
+                previous_name = (
+                    Document.objects.select_for_update().filter(pk=self.pk)
+                    .values_list('file', flat=True).first()
+                )
+                if not assigned_file and self.file.name != previous_name:
+                    # The file was replaced since this instance was loaded; keep the new one.
+                    self.file = previous_name
+                    self.clean()
+            # ContentAddressedStorage takes the reference for a file it stores; a stored
+            # name assigned directly takes one here. The replaced file gives its back.
+            if saving_file and assigned_file and not storing_file and self.file.name != previous_name:
+                self._acquire_assigned_file()
+            super().save(*args, **kwargs)
+            if previous_name and assigned_file and (storing_file or self.file.name != previous_name):
+                FileBlob.release(previous_name)
+        if saving_file:
+            self._loaded_file_name = self.file.name or None
 
         if is_new:
-            from .tasks import process_document 
-            process_document.delay(self.id)
+            from .dispatch import enqueue_document_processing
+            # Wait for the commit, or the worker may not see the row yet.
+            transaction.on_commit(lambda: enqueue_document_processing(self.id))
+
+    def _acquire_assigned_file(self):
+        name = self.file.name
+        if not name or sha256_from_name(name) is None:
+            return
+        if not self.file.storage.exists(name):
+            raise ValidationError({'file': f"{name} is no longer stored; upload the file again."})
+        FileBlob.acquire(name, self.file.storage.size(name))
+
     def __str__(self):
         return f"{self.title} ({self.file_type})"
 
+@receiver(post_delete, sender=Document)
+def release_document_file(sender, instance, **kwargs):
+    if instance.file:
+        FileBlob.release(instance.file.name)
+
+
+@receiver(post_delete, sender=Document)
+def rebalance_after_delete(sender, instance, **kwargs):
+    if settings.VECTOR_SHARDS > 1:
+        from .dispatch import enqueue_shard_rebalance
+        transaction.on_commit(lambda: enqueue_shard_rebalance(instance.owner_id))
+
+
 class Embedding(models.Model):
     document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='embeddings')
-    embedding = models.BinaryField()  
+    # Legacy pickled vector; new rows keep their vector in the owner's VectorSegment.
+    embedding = models.BinaryField(null=True, blank=True)
+    vector_offset = models.BigIntegerField(null=True, blank=True)
     text_chunk = models.TextField()
     chunk_index = models.IntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        verbose_name = 'Document Embedding'
+        verbose_name_plural = 'Document Embeddings'
+        ordering = ['document', 'chunk_index']
+
     def clean(self):
+        if self.vector_offset is not None:
+            return
         try:
-           
             vector = pickle.loads(self.embedding)
-            expected_dim = 384  
-            if not isinstance(vector, list) or len(vector) != expected_dim:
-                raise ValidationError(f"Embedding must be a list of {expected_dim} floats.")
         except Exception:
             raise ValidationError("Invalid embedding format. Must be a pickled list of floats.")
+        if not isinstance(vector, list) or not vector:
+            raise ValidationError("Embedding must be a non-empty list of floats.")
 
     def save(self, *args, **kwargs):
         self.full_clean()  
@@ -56,6 +195,18 @@ class Embedding(models.Model):
     def __str__(self):
         return f"Embedding {self.chunk_index} for {self.document.title}"
 
+class VectorSegmentState(models.Model):
+    """The compaction generation of a user's vector segment that ``Embedding.vector_offset`` refers to.
+
+    Committed together with the offsets a compaction assigns; the segment
+    file records the generation its rows are laid out for.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    generation = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Vector segment of user {self.user_id} (generation {self.generation})"
+
 class ChatSession(models.Model):
     """Tracks a conversation session between user and bot"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chat_sessions')
@@ -0,0 +1,104 @@
+from billiard.pool import Pool
+from django.conf import settings
+from langchain_community.document_loaders import Docx2txtLoader, TextLoader
+from langchain_core.documents import Document as LangchainDocument
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pypdf import PdfReader
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# Stored with cached chunks; change it whenever splitting would give different output.
+SPLIT_VERSION = f'recursive-{CHUNK_SIZE}-{CHUNK_OVERLAP}'
+
+# Set in each pool process by _open_reader so pages are parsed from one open file.
+_reader = None
+
+
+def _open_reader(path):
+    global _reader
+    _reader = PdfReader(path)
+
+
+def _extract_page(page_number):
+    return _reader.pages[page_number].extract_text()
+
+
+def iter_pdf_pages(path):
+    """Yield one document per PDF page, in page order.
+
+    Pages are extracted by a pool of ``PDF_PARSE_WORKERS`` processes
+    (billiard, so it also works inside Celery's daemonic workers), or by
+    a single one for PDFs under ``PDF_PARALLEL_MIN_PAGES`` pages. A page
+    that fails, or takes longer than ``PDF_PAGE_TIMEOUT`` seconds and gets
+    its process killed and replaced, is skipped instead of failing the
+    whole document. With ``PDF_PAGE_TIMEOUT`` set to 0 pages are extracted
+    in process, still skipping pages that fail, but with no time limit.
+    """
+    reader = PdfReader(path)
+    total_pages = len(reader.pages)
+    workers = 1 if total_pages < settings.PDF_PARALLEL_MIN_PAGES else max(1, min(settings.PDF_PARSE_WORKERS, total_pages))
+
+    def page_document(page_number, text):
+        return LangchainDocument(
+            page_content=text,
+            metadata={'source': path, 'page': page_number, 'total_pages': total_pages}
+        )
+
+    if settings.PDF_PAGE_TIMEOUT <= 0:
+        for page_number, page in enumerate(reader.pages):
+            try:
+                text = page.extract_text()
+            except Exception as e:
+                print(f"Skipping page {page_number} of {path}: {e!r}")
+                continue
+            yield page_document(page_number, text)
+        return
+
+    # Even one page goes through a pool process: only there can a hanging page be killed.
+    pool = Pool(
+        workers,
+        initializer=_open_reader,
+        initargs=(path,),
+        timeout=settings.PDF_PAGE_TIMEOUT,
+        enable_timeouts=True,
+    )
+    try:
+        results = [pool.apply_async(_extract_page, (n,)) for n in range(total_pages)]
+        for page_number, result in enumerate(results):
+            try:
+                text = result.get()
+            except Exception as e:
+                # Worker errors arrive wrapped with their remote traceback.
+                print(f"Skipping page {page_number} of {path}: {getattr(e, 'exc', e)!r}")
+                continue
+            yield page_document(page_number, text)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def split_file(path, file_type):
+    """Load ``path`` and split it into text chunks, feeding the splitter page by page."""
+    if file_type == 'pdf':
+        pages = iter_pdf_pages(path)
+    elif file_type == 'docx':
+        pages = Docx2txtLoader(path).lazy_load()
+    elif file_type == 'txt':
+        pages = TextLoader(path).lazy_load()
+    else:
+        raise ValueError(f"Unsupported file type: {file_type}")
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    chunks = []
+    for page in pages:
+        chunks.extend(text_splitter.split_documents([page]))
+    return chunks
+
+
+def dump_chunks(chunks):
+    """JSON-serializable form of ``chunks`` for the per-file parse cache."""
+    return [{'text': chunk.page_content, 'metadata': chunk.metadata} for chunk in chunks]
+
+
+def load_chunks(data):
+    return [LangchainDocument(page_content=item['text'], metadata=item['metadata']) for item in data]
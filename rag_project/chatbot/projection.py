@@ -0,0 +1,92 @@
+import json
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import faiss
+import numpy as np
+from django.conf import settings
+
+KINDS = ('pca', 'opq')
+
+
+def projection_dir():
+    return Path(settings.VECTOR_STORE_PATH) / 'projections'
+
+
+def available_versions():
+    return sorted(int(path.stem[1:]) for path in projection_dir().glob('v*.json'))
+
+
+def make_transform(kind, d_in, dimension):
+    """An untrained faiss transform of ``kind`` from ``d_in`` to ``dimension`` dimensions."""
+    if not 0 < dimension < d_in:
+        raise ValueError(f"Target dimension must be between 1 and {d_in - 1}.")
+    if kind == 'pca':
+        return faiss.PCAMatrix(d_in, dimension)
+    if kind == 'opq':
+        # Rotation tuned for product quantization; PQ needs dimension divisible by its sub-quantizers.
+        m = max(1, min(settings.VECTOR_PQ_M, dimension))
+        while dimension % m:
+            m -= 1
+        return faiss.OPQMatrix(d_in, m, dimension)
+    raise ValueError(f"Unknown projection kind: {kind}")
+
+
+class Projection:
+    """A trained linear map from raw embeddings to ``d_out`` dimensions.
+
+    Versions are numbered from 1 and never change once written; version 0
+    means "unprojected". Each is stored as ``v<version>.faiss`` plus a JSON
+    description under ``VECTOR_STORE_PATH/projections``.
+    """
+
+    def __init__(self, version, transform, meta):
+        self.version = version
+        self.transform = transform
+        self.meta = meta
+        self.d_in = transform.d_in
+        self.d_out = transform.d_out
+
+    @classmethod
+    def train(cls, sample, kind, dimension):
+        """Fit a ``kind`` projection to ``dimension`` on ``sample`` and save it as the next version."""
+        sample = np.ascontiguousarray(sample, dtype='float32')
+        d_in = sample.shape[1]
+        transform = make_transform(kind, d_in, dimension)
+        if kind == 'opq' and len(sample) < 256:
+            raise ValueError(f"OPQ trains 256-centroid codebooks and needs at least 256 vectors, got {len(sample)}.")
+        transform.train(sample)
+
+        directory = projection_dir()
+        directory.mkdir(parents=True, exist_ok=True)
+        version = max(available_versions(), default=0) + 1
+        meta = {'kind': kind, 'd_in': d_in, 'd_out': dimension, 'trained_on': len(sample), 'created': time.time()}
+        faiss.write_VectorTransform(transform, str(directory / f'v{version}.faiss'))
+        # The JSON file is what marks the version as available, so it is written last.
+        (directory / f'v{version}.json').write_text(json.dumps(meta))
+        return cls(version, transform, meta)
+
+    def apply(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        if vectors.ndim != 2 or vectors.shape[1] != self.d_in:
+            raise ValueError(f"Projection v{self.version} expects {self.d_in}-d vectors, got shape {vectors.shape}.")
+        return self.transform.apply(vectors)
+
+    def reverse(self, vectors):
+        """Map projected vectors back to raw vectors that project onto them."""
+        return self.transform.reverse_transform(np.ascontiguousarray(vectors, dtype='float32'))
+
+
+@lru_cache(maxsize=None)
+def load_projection(version):
+    path = projection_dir() / f'v{version}'
+    meta = json.loads(path.with_suffix('.json').read_text())
+    return Projection(version, faiss.read_VectorTransform(str(path.with_suffix('.faiss'))), meta)
+
+
+def project(vectors, version):
+    """Apply projection ``version`` to a 2D array of raw embeddings; version 0 returns them unchanged."""
+    if not version:
+        return np.ascontiguousarray(vectors, dtype='float32')
+    return load_projection(version).apply(vectors)
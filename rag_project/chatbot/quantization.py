@@ -0,0 +1,163 @@
+from collections import OrderedDict
+from pathlib import Path
+
+import faiss
+import numpy as np
+from django.conf import settings
+from filelock import FileLock
+
+MODES = ('flat', 'sq8', 'pq')
+
+# Indexes loaded by this process, most recently used last.
+_loaded = OrderedDict()
+
+
+def choose_mode(user_id, n_vectors):
+    """Return the vector representation to search ``user_id``'s corpus with.
+
+    ``VECTOR_QUANTIZATION_USERS`` pins a mode per user; otherwise
+    ``VECTOR_QUANTIZATION`` applies, where ``auto`` picks by corpus size.
+    """
+    mode = settings.VECTOR_QUANTIZATION_USERS.get(str(user_id), settings.VECTOR_QUANTIZATION)
+    if mode == 'auto':
+        if n_vectors >= settings.VECTOR_QUANTIZATION_PQ_MIN:
+            mode = 'pq'
+        elif n_vectors >= settings.VECTOR_QUANTIZATION_SQ8_MIN:
+            mode = 'sq8'
+        else:
+            mode = 'flat'
+    if mode not in MODES:
+        raise ValueError(f"Unknown vector quantization mode: {mode}")
+    return mode
+
+
+def _pq_subquantizers(dimension):
+    m = min(settings.VECTOR_PQ_M, dimension)
+    while dimension % m:
+        m -= 1
+    return m
+
+
+def build_index(vectors, mode, batch_size=65536):
+    """Train a compressed IVF index on a sample of ``vectors`` and add them all.
+
+    ``vectors`` only needs ``shape`` and slicing, so a memory map (or
+    :class:`SegmentRows`) is read in batches rather than loaded whole.
+    """
+    n_vectors, dimension = vectors.shape
+    sample_size = min(n_vectors, settings.VECTOR_INDEX_TRAIN_SAMPLE)
+    # FAISS needs at least 39 training points per list; tiny corpora (e.g. users pinned to a mode) get one list.
+    nlist = max(1, min(settings.VECTOR_INDEX_MAX_LISTS, int(4 * n_vectors ** 0.5), sample_size // 39))
+    if mode == 'pq' and sample_size >= 256 * 39:
+        factory = f"IVF{nlist},PQ{_pq_subquantizers(dimension)}x8"
+    else:
+        # Product quantizers need thousands of training points; small corpora use SQ8.
+        factory = f"IVF{nlist},SQ8"
+    index = faiss.index_factory(dimension, factory, faiss.METRIC_L2)
+
+    sample = np.sort(np.random.default_rng(0).choice(n_vectors, sample_size, replace=False))
+    index.train(np.ascontiguousarray(vectors[sample], dtype='float32'))
+    for start in range(0, n_vectors, batch_size):
+        index.add(np.ascontiguousarray(vectors[start:start + batch_size], dtype='float32'))
+    return index
+
+
+class SegmentRows:
+    """Rows of a segment memory map selected by offset, sliceable without copying the rest."""
+
+    def __init__(self, vectors, offsets):
+        self.vectors = vectors
+        self.offsets = np.asarray(offsets, dtype='int64')
+        self.shape = (len(self.offsets), vectors.shape[1])
+
+    def __getitem__(self, item):
+        return self.vectors[self.offsets[item]]
+
+
+class CompressedIndex:
+    """A user's quantized FAISS index persisted under ``FAISS_INDEX_PATH``.
+
+    ``ids`` maps index positions to ``Embedding`` ids. ``version`` identifies
+    the corpus the index was last synced with; ``trained_on`` is the corpus
+    size the quantizer was trained for. Open, rebuild and extend it while
+    holding :attr:`lock`. A sharded corpus has one index per ``shard``.
+    """
+
+    def __init__(self, user_id, mode, shard=None):
+        directory = Path(settings.FAISS_INDEX_PATH)
+        stem = f'user_{user_id}.{mode}' if shard is None else f'user_{user_id}.shard{shard}.{mode}'
+        self.index_path = directory / f'{stem}.faiss'
+        self.meta_path = directory / f'{stem}.npz'
+        self.lock = FileLock(directory / f'{stem}.lock')
+        self.key = (user_id, mode, shard)
+        self.index = None
+        self.ids = np.empty(0, dtype='int64')
+        self.version = None
+        self.trained_on = 0
+        self._mtime = None
+
+    @classmethod
+    def open(cls, user_id, mode, shard=None):
+        """Return the index from this process's cache, falling back to disk."""
+        key = (user_id, mode, shard)
+        if key in _loaded:
+            _loaded.move_to_end(key)
+            cached = _loaded[key]
+            if cached.meta_path.exists() and cached.meta_path.stat().st_mtime_ns == cached._mtime:
+                return cached
+
+        compressed = cls(user_id, mode, shard)
+        if compressed.meta_path.exists() and compressed.index_path.exists():
+            meta = np.load(compressed.meta_path)
+            compressed.ids = meta['ids']
+            compressed.version = str(meta['version'])
+            compressed.trained_on = int(meta['trained_on'])
+            compressed.index = faiss.read_index(str(compressed.index_path))
+            compressed._mtime = compressed.meta_path.stat().st_mtime_ns
+            _loaded[key] = compressed
+            while len(_loaded) > settings.VECTOR_INDEX_CACHE_SIZE:
+                _loaded.popitem(last=False)
+        return compressed
+
+    def needs_rebuild(self, live_ids):
+        """Whether to retrain rather than append, given the ids currently in the corpus."""
+        if self.index is None:
+            return True
+        dead = len(self.ids) - np.isin(self.ids, live_ids, assume_unique=True).sum()
+        return dead > settings.VECTOR_INDEX_MAX_DEAD_RATIO * len(self.ids) or len(live_ids) > 2 * self.trained_on
+
+    def rebuild(self, vectors, ids, version, mode):
+        self.index = build_index(vectors, mode)
+        self.ids = np.asarray(ids, dtype='int64')
+        self.trained_on = len(self.ids)
+        self.version = version
+        self.save()
+
+    def extend(self, vectors, ids, version):
+        """Add new rows to the trained index; removed rows are filtered out at search time."""
+        for start in range(0, len(ids), 65536):
+            self.index.add(np.ascontiguousarray(vectors[start:start + 65536], dtype='float32'))
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype='int64')])
+        self.version = version
+        self.save()
+
+    def save(self):
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_index = self.index_path.with_name(self.index_path.name + '.tmp')
+        tmp_meta = self.meta_path.with_name(self.meta_path.name + '.tmp')
+        faiss.write_index(self.index, str(tmp_index))
+        with open(tmp_meta, 'wb') as f:
+            np.savez(f, ids=self.ids, version=self.version, trained_on=self.trained_on)
+        tmp_index.replace(self.index_path)
+        tmp_meta.replace(self.meta_path)
+        self._mtime = self.meta_path.stat().st_mtime_ns
+        _loaded[self.key] = self
+
+    def search(self, query_vector, n_candidates):
+        """Return the Embedding ids of the ``n_candidates`` nearest compressed vectors."""
+        self.index.nprobe = settings.VECTOR_INDEX_NPROBE
+        _, positions = self.index.search(np.array([query_vector], dtype='float32'), n_candidates)
+        return [int(self.ids[p]) for p in positions[0] if 0 <= p < len(self.ids)]
+
+    def memory_bytes(self):
+        return faiss.serialize_index(self.index).nbytes
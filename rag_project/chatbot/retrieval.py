@@ -0,0 +1,295 @@
+from functools import lru_cache
+
+import faiss
+import numpy as np
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Count, Max, Sum
+from django.utils.module_loading import import_string
+
+from .models import Embedding
+from .quantization import CompressedIndex, SegmentRows, choose_mode
+from .vector_store import VectorSegment, compact_user_vectors, load_vectors
+
+RESULT_FIELDS = ('id', 'text_chunk', 'document_id', 'document__title')
+
+
+def searchable_chunks(user):
+    return Embedding.objects.filter(document__owner=user, document__processed=True)
+
+
+def corpus_version(corpus):
+    """Return the number of chunks in the ``corpus`` queryset and a version string.
+
+    The version changes whenever chunks are added to or removed from it.
+    """
+    stats = corpus.aggregate(count=Count('id'), max_id=Max('id'), id_sum=Sum('id'))
+    return stats['count'], f"{stats['count']}-{stats['max_id']}-{stats['id_sum']}"
+
+
+class RetrievalBackend:
+    """Stores chunk vectors and finds the chunks nearest to a query for one user.
+
+    ``search`` returns dicts with the ``RESULT_FIELDS`` of the matching
+    ``Embedding`` rows plus their ``distance``, nearest first.
+    """
+
+    def add(self, document, chunks, vectors, chunk_indexes=None):
+        """Create the ``Embedding`` rows for ``chunks`` and index ``vectors``.
+
+        ``chunk_indexes`` defaults to the chunks' positions in ``chunks``.
+        """
+        raise NotImplementedError
+
+    def remove(self, embeddings):
+        """Delete ``embeddings`` and drop their vectors from the index."""
+        Embedding.objects.filter(id__in=[embedding.id for embedding in embeddings]).delete()
+
+    def search(self, user, query_vector, k):
+        raise NotImplementedError
+
+    def rebalance(self, user_id):
+        """Redistribute ``user_id``'s vectors after documents were deleted; nothing to do unless sharded."""
+        return 0
+
+
+class FaissBackend(RetrievalBackend):
+    """Vectors in the owner's memory-mapped segment, searched with FAISS.
+
+    Small corpora get an exact IVF index built per query. Larger ones (see
+    ``choose_mode``) are searched through a persisted int8 or product-quantized
+    index whose top candidates are re-scored with full-precision vectors.
+    Removed embeddings leave dead rows in the segment until it is compacted.
+    Queries are projected like the segment's rows (see ``chatbot.projection``).
+    """
+
+    def add(self, document, chunks, vectors, chunk_indexes=None):
+        if chunk_indexes is None:
+            chunk_indexes = range(len(chunks))
+        # The lock covers the append and the rows so compaction never sees half a write.
+        segment = VectorSegment(document.owner_id)
+        with segment.lock:
+            offsets = segment.append(vectors)
+            return Embedding.objects.bulk_create([
+                Embedding(
+                    document=document,
+                    vector_offset=offset,
+                    text_chunk=chunk.page_content,
+                    chunk_index=i
+                )
+                for i, chunk, offset in zip(chunk_indexes, chunks, offsets)
+            ])
+
+    def search(self, user, query_vector, k):
+        return self.search_corpus(user, searchable_chunks(user), query_vector, k)
+
+    def search_corpus(self, user, corpus, query_vector, k, shard=None, stats=None):
+        """Search ``corpus``, a subset of ``user``'s chunks.
+
+        Compressed indexes are kept per ``shard`` when one is given. ``stats``
+        is the corpus's :func:`corpus_version`, if the caller already has it.
+        """
+        count, version = stats or corpus_version(corpus)
+        if not count:
+            return []
+
+        segment = VectorSegment(user.pk)
+        query_vector = segment.project([query_vector])[0]
+        mode = choose_mode(user.pk, count)
+        if mode == 'flat':
+            return self._search_flat(user, corpus, query_vector, k)
+        # Re-projecting a segment keeps the Embedding ids, so the version has to name the projection too.
+        version = f"{version}-p{segment.projection}"
+        return self._search_compressed(user, corpus, query_vector, k, mode, version, shard)
+
+    def _search_flat(self, user, corpus, query_vector, k):
+        segment = VectorSegment(user.pk)
+        with segment.lock:
+            rows = list(
+                corpus
+                .order_by('vector_offset', 'id')
+                .values(*RESULT_FIELDS, 'vector_offset', 'embedding')
+            )
+            np_embeddings = load_vectors(segment, rows)
+
+        if not rows:
+            return []
+
+        dimension = np_embeddings.shape[1]
+        n_vectors = len(np_embeddings)
+        nlist = min(100, max(1, int(n_vectors ** 0.5)))
+
+        quantizer = faiss.IndexFlatL2(dimension)
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
+
+        if not index.is_trained:
+            index.train(np_embeddings)
+        index.add(np_embeddings)
+
+        distances, indices = index.search(np.array([query_vector], dtype='float32'), k=min(k, n_vectors))
+        return [
+            dict(rows[i], distance=float(distance))
+            for distance, i in zip(distances[0], indices[0])
+            if 0 <= i < len(rows)
+        ]
+
+    def _search_compressed(self, user, corpus, query_vector, k, mode, version, shard=None):
+        if corpus.filter(vector_offset__isnull=True).exists():
+            # Moves legacy pickled vectors into the segment so they can be indexed.
+            compact_user_vectors(user.pk)
+
+        segment = VectorSegment(user.pk)
+        lock = CompressedIndex(user.pk, mode, shard).lock
+        with lock:
+            compressed = CompressedIndex.open(user.pk, mode, shard)
+            if compressed.version != version:
+                # A memory map stays valid even if compaction replaces the file
+                # afterwards, so the segment lock is only held for the snapshot.
+                with segment.lock:
+                    live = np.array(corpus.order_by('vector_offset').values_list('id', 'vector_offset'), dtype='int64')
+                    vectors = segment.vectors()
+                ids, offsets = live[:, 0], live[:, 1]
+                if compressed.needs_rebuild(ids) or compressed.index.d != vectors.shape[1]:
+                    compressed.rebuild(SegmentRows(vectors, offsets), ids, version, mode)
+                else:
+                    new = ~np.isin(ids, compressed.ids)
+                    compressed.extend(SegmentRows(vectors, offsets[new]), ids[new], version)
+
+        n_candidates = min(len(compressed.ids), k * settings.VECTOR_RERANK_FACTOR)
+        candidate_ids = compressed.search(query_vector, n_candidates)
+
+        # Re-score the candidates against their full-precision vectors. This
+        # also drops embeddings removed since the index was last synced.
+        with segment.lock:
+            rows = list(corpus.filter(id__in=candidate_ids).values(*RESULT_FIELDS, 'vector_offset'))
+            vectors = segment.vectors()
+        if not rows:
+            return []
+        candidates = np.asarray(vectors[[row['vector_offset'] for row in rows]], dtype='float32')
+        distances = ((candidates - np.asarray(query_vector, dtype='float32')) ** 2).sum(axis=1)
+        return [dict(rows[i], distance=float(distances[i])) for i in np.argsort(distances)[:k]]
+
+
+class PgVectorBackend(RetrievalBackend):
+    """Vectors in a pgvector column next to the ``Embedding`` table, searched in SQL.
+
+    Requires PostgreSQL with the ``vector`` extension; migration ``0005``
+    creates the table and its HNSW index, and ``manage.py backfill_pgvector``
+    copies in vectors stored before switching to this backend. pgvector only
+    indexes up to 2000 dimensions, so wider vectors (``mistral``: 4096) are
+    indexed through a ``PGVECTOR_INDEX_DIMENSIONS``-wide :meth:`sketch`, and
+    the ``k * VECTOR_RERANK_FACTOR`` nearest sketches are re-ranked by exact
+    distance.
+    """
+
+    table = 'chatbot_embedding_vector'
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.dimensions = settings.PGVECTOR_DIMENSIONS
+        self.index_dimensions = min(self.dimensions, settings.PGVECTOR_INDEX_DIMENSIONS)
+        self.sketched = self.index_dimensions < self.dimensions
+
+    @staticmethod
+    def _literal(vector):
+        return '[' + ','.join(repr(float(x)) for x in vector) + ']'
+
+    def sketch(self, vectors):
+        """Count-sketch a 2D array of vectors down to ``index_dimensions``.
+
+        Coordinate ``i`` is added, with a fixed pseudo-random sign, to output
+        ``i % index_dimensions``. This needs no training, so stored rows and
+        queries always agree, and preserves L2 distances in expectation.
+        """
+        vectors = np.asarray(vectors, dtype='float32')
+        coordinates = np.arange(vectors.shape[1], dtype='uint64')
+        signs = 1 - 2 * ((coordinates * np.uint64(2654435761) >> np.uint64(16)) & np.uint64(1)).astype('float32')
+        blocks = -(-vectors.shape[1] // self.index_dimensions)
+        padded = np.zeros((len(vectors), blocks * self.index_dimensions), dtype='float32')
+        padded[:, :vectors.shape[1]] = vectors * signs
+        return padded.reshape(len(vectors), blocks, self.index_dimensions).sum(axis=1)
+
+    def write(self, owner_id, embedding_ids, vectors):
+        """Insert (or replace) the vector rows of ``embedding_ids``."""
+        vectors = np.asarray(vectors, dtype='float32')
+        if vectors.ndim != 2 or vectors.shape[1] != self.dimensions:
+            raise ValueError(f"PGVECTOR_DIMENSIONS is {self.dimensions}, got vectors of shape {vectors.shape}.")
+        columns = ['embedding_id', 'owner_id', 'vector']
+        rows = [[embedding_id, owner_id, self._literal(vector)] for embedding_id, vector in zip(embedding_ids, vectors)]
+        if self.sketched:
+            columns.append('sketch')
+            for row, sketch in zip(rows, self.sketch(vectors)):
+                row.append(self._literal(sketch))
+        with connections[self.using].cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table} ({', '.join(columns)})"
+                f" VALUES (%s, %s, {', '.join(['%s::vector'] * (len(columns) - 2))})"
+                " ON CONFLICT (embedding_id) DO UPDATE SET "
+                + ', '.join(f"{column} = EXCLUDED.{column}" for column in columns[1:]),
+                rows
+            )
+
+    def add(self, document, chunks, vectors, chunk_indexes=None):
+        if chunk_indexes is None:
+            chunk_indexes = range(len(chunks))
+        with transaction.atomic(using=self.using):
+            embeddings = Embedding.objects.using(self.using).bulk_create([
+                Embedding(document=document, text_chunk=chunk.page_content, chunk_index=i)
+                for i, chunk in zip(chunk_indexes, chunks)
+            ])
+            self.write(document.owner_id, [embedding.id for embedding in embeddings], vectors)
+        return embeddings
+
+    def remove(self, embeddings):
+        # Vector rows go with their embeddings through ON DELETE CASCADE.
+        Embedding.objects.using(self.using).filter(id__in=[embedding.id for embedding in embeddings]).delete()
+
+    def search(self, user, query_vector, k):
+        query = self._literal(query_vector)
+        candidates = k * settings.VECTOR_RERANK_FACTOR if self.sketched else k
+        owned = (
+            f" FROM {self.table} v"
+            " JOIN chatbot_embedding e ON e.id = v.embedding_id"
+            " JOIN chatbot_document d ON d.id = e.document_id"
+            " WHERE v.owner_id = %s AND d.processed"
+        )
+        if self.sketched:
+            sql = (
+                "SELECT embedding_id, vector <-> %s::vector AS distance FROM ("
+                f" SELECT v.embedding_id, v.vector{owned} ORDER BY v.sketch <-> %s::vector LIMIT %s"
+                ") candidates ORDER BY distance LIMIT %s"
+            )
+            sketch = self._literal(self.sketch([query_vector])[0])
+            params = [query, user.pk, sketch, candidates, k]
+        else:
+            sql = f"SELECT v.embedding_id, v.vector <-> %s::vector AS distance{owned} ORDER BY 2 LIMIT %s"
+            params = [query, user.pk, k]
+
+        with transaction.atomic(using=self.using), connections[self.using].cursor() as cursor:
+            # SET does not take bind parameters; both values come from settings.
+            cursor.execute(f"SET LOCAL hnsw.ef_search = {int(max(candidates, settings.PGVECTOR_HNSW_EF_SEARCH))}")
+            if settings.PGVECTOR_ITERATIVE_SCAN in ('strict_order', 'relaxed_order'):
+                # Setting an unknown hnsw.* parameter is an error, and pgvector < 0.8 has no iterative scans.
+                cursor.execute("SELECT current_setting('hnsw.iterative_scan', true)")
+                if cursor.fetchone()[0] is not None:
+                    cursor.execute(f"SET LOCAL hnsw.iterative_scan = {settings.PGVECTOR_ITERATIVE_SCAN}")
+            cursor.execute(sql, params)
+            hits = cursor.fetchall()
+
+        rows = {
+            row['id']: row
+            for row in Embedding.objects.using(self.using)
+            .filter(id__in=[embedding_id for embedding_id, _ in hits])
+            .values(*RESULT_FIELDS)
+        }
+        return [
+            dict(rows[embedding_id], distance=distance)
+            for embedding_id, distance in hits
+            if embedding_id in rows
+        ]
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    """Return the retrieval backend configured by ``RETRIEVAL_BACKEND``."""
+    return import_string(settings.RETRIEVAL_BACKEND)()
@@ -1,24 +1,53 @@
 import graphene
+from django.db import transaction
 from graphene_django import DjangoObjectType
 
-from chatbot.tasks import generate_chat_response
-from .models import Document, ChatSession, ChatMessage
+from .admission import admitted
+from .dispatch import enqueue_chat_response
+from .loaders import get_loaders
+from .models import Document, ChatSession, ChatMessage, Embedding
 
 
+class EmbeddingType(DjangoObjectType):
+    document = graphene.Field(lambda: DocumentType)
+
+    class Meta:
+        model = Embedding
+        # The binary vector is never exposed through the API.
+        fields = ("id", "text_chunk", "chunk_index", "created_at", "document")
+
+    def resolve_document(self, info):
+        return get_loaders(info).documents.load(self.document_id)
+
 class DocumentType(DjangoObjectType):
+    embeddings = graphene.List(graphene.NonNull(EmbeddingType))
+
     class Meta:
         model = Document
-        fields = "__all__"
+        fields = ("id", "title", "file", "file_type", "uploaded_at", "processed", "embeddings")
 
-class ChatSessionType(DjangoObjectType):
-    class Meta:
-        model = ChatSession
-        fields = "__all__"
+    def resolve_embeddings(self, info):
+        return get_loaders(info).document_embeddings.load(self.id)
 
 class ChatMessageType(DjangoObjectType):
+    references = graphene.List(graphene.NonNull(EmbeddingType))
+
     class Meta:
         model = ChatMessage
-        fields = "__all__"
+        fields = ("id", "message", "is_user", "created_at", "session", "references")
+
+    def resolve_references(self, info):
+        return get_loaders(info).message_references.load(self.id)
+
+class ChatSessionType(DjangoObjectType):
+    messages = graphene.List(graphene.NonNull(ChatMessageType))
+
+    class Meta:
+        model = ChatSession
+        fields = ("id", "title", "created_at", "messages")
+
+    def resolve_messages(self, info):
+        return get_loaders(info).session_messages.load(self.id)
 
 
 class Query(graphene.ObjectType):
@@ -30,19 +59,30 @@ class Query(graphene.ObjectType):
         user = info.context.user
         if not user.is_authenticated:
             return Document.objects.none()
-        return Document.objects.filter(owner=user)
+        documents = list(Document.objects.filter(owner=user))
+        loaders = get_loaders(info)
+        for document in documents:
+            loaders.documents.prime(document.id, document)
+        loaders.document_embeddings.queue(document.id for document in documents)
+        return documents
 
     def resolve_chat_sessions(self, info):
         user = info.context.user
         if not user.is_authenticated:
             return ChatSession.objects.none()
-        return ChatSession.objects.filter(user=user)
+        sessions = list(ChatSession.objects.filter(user=user))
+        get_loaders(info).session_messages.queue(session.id for session in sessions)
+        return sessions
 
     def resolve_chat_messages(self, info, session_id):
         user = info.context.user
         if not user.is_authenticated:
             return ChatMessage.objects.none()
-        return ChatMessage.objects.filter(session__user=user, session_id=session_id)
+        messages = list(
+            ChatMessage.objects.filter(session__user=user, session_id=session_id).select_related('session')
+        )
+        get_loaders(info).message_references.queue(message.id for message in messages)
+        return messages
 
 
 class CreateDocument(graphene.Mutation):
@@ -79,15 +119,17 @@ class CreateChatMessage(graphene.Mutation):
         except ChatSession.DoesNotExist:
             raise Exception("Chat session not found")
 
-        
-        chat_message = ChatMessage.objects.create(
-            session=session,
-            message=message,
-            is_user=True
-        )
-
-        
-        generate_chat_response.delay(session_id, chat_message.id)
+        with admitted() as ticket:
+            if ticket is None:
+                raise Exception("The assistant is busy answering other questions. Please try again shortly.")
+
+            with transaction.atomic():
+                chat_message = ChatMessage.objects.create(
+                    session=session,
+                    message=message,
+                    is_user=True
+                )
+                transaction.on_commit(lambda: enqueue_chat_response(session_id, chat_message.id, ticket))
 
         return CreateChatMessage(chat_message=chat_message)
 
@@ -0,0 +1,138 @@
+import heapq
+from pathlib import Path
+
+from celery import current_app, group
+from django.conf import settings
+from django.db.models import Count
+from filelock import FileLock
+
+from .models import Document, Embedding
+from .retrieval import RESULT_FIELDS, FaissBackend, corpus_version, searchable_chunks
+
+
+def shard_queue(shard):
+    return f'{settings.VECTOR_SHARD_QUEUE_PREFIX}-{shard}'
+
+
+def shard_loads(user_id):
+    """Return ``{shard: chunk count}`` for every configured shard and ``{document_id: chunk count}``."""
+    sizes = dict(
+        Document.objects.filter(owner_id=user_id)
+        .annotate(chunks=Count('embeddings'))
+        .values_list('id', 'chunks')
+    )
+    loads = dict.fromkeys(range(settings.VECTOR_SHARDS), 0)
+    for document_id, shard in Document.objects.filter(owner_id=user_id).values_list('id', 'shard'):
+        if shard in loads:
+            loads[shard] += sizes[document_id]
+    return loads, sizes
+
+
+def rebalance_shards(user_id):
+    """Spread ``user_id``'s documents over the ``VECTOR_SHARDS`` shards by chunk count.
+
+    Unassigned documents (and those on shards that no longer exist) go to the
+    least loaded shard, largest first. Then, while the largest and smallest
+    shards differ by more than ``VECTOR_SHARD_IMBALANCE`` of the average
+    load, the biggest document that narrows the gap is moved. Returns the
+    number of documents whose shard changed; each shard worker picks up the
+    change on its next query.
+    """
+    with FileLock(Path(settings.VECTOR_STORE_PATH) / f'user_{user_id}.shards.lock'):
+        documents = list(Document.objects.filter(owner_id=user_id).only('id', 'shard'))
+        loads, sizes = shard_loads(user_id)
+        members = {shard: [] for shard in loads}
+        changed = []
+
+        unassigned = [document for document in documents if document.shard not in loads]
+        for document in sorted(unassigned, key=lambda document: -sizes[document.id]):
+            document.shard = min(loads, key=loads.get)
+            loads[document.shard] += sizes[document.id]
+            changed.append(document)
+        for document in documents:
+            members[document.shard].append(document)
+
+        tolerance = max(1, settings.VECTOR_SHARD_IMBALANCE * sum(loads.values()) / len(loads))
+        while True:
+            largest = max(loads, key=loads.get)
+            smallest = min(loads, key=loads.get)
+            gap = loads[largest] - loads[smallest]
+            movable = [document for document in members[largest] if 0 < sizes[document.id] < gap]
+            if gap <= tolerance or not movable:
+                break
+            document = max(movable, key=lambda document: sizes[document.id])
+            members[largest].remove(document)
+            members[smallest].append(document)
+            loads[largest] -= sizes[document.id]
+            loads[smallest] += sizes[document.id]
+            document.shard = smallest
+            changed.append(document)
+
+        Document.objects.bulk_update(set(changed), ['shard'])
+        return len(set(changed))
+
+
+class ShardedFaissBackend(FaissBackend):
+    """:class:`FaissBackend` with each user's documents spread over ``VECTOR_SHARDS`` shards.
+
+    Shard ``n`` is searched by the ``search_shard`` task on the
+    ``<VECTOR_SHARD_QUEUE_PREFIX>-<n>`` queue, so the worker(s) consuming
+    that queue only load the vectors and compressed index of their shard.
+    A query fans out to all shards and their top-k lists are merged.
+    Corpora below ``VECTOR_SHARD_MIN_VECTORS`` chunks are searched in
+    process. Vectors stay in the owner's segment under
+    ``VECTOR_STORE_PATH``, which shard workers on other machines must share.
+    """
+
+    def add(self, document, chunks, vectors, chunk_indexes=None):
+        embeddings = super().add(document, chunks, vectors, chunk_indexes)
+        rebalance_shards(document.owner_id)
+        # Keep ``document`` in step with the shard it was given.
+        document.refresh_from_db(fields=['shard'])
+        return embeddings
+
+    def remove(self, embeddings):
+        owners = set(
+            Embedding.objects.filter(id__in=[embedding.id for embedding in embeddings])
+            .values_list('document__owner_id', flat=True)
+        )
+        super().remove(embeddings)
+        for owner_id in owners:
+            rebalance_shards(owner_id)
+
+    def rebalance(self, user_id):
+        return rebalance_shards(user_id)
+
+    def search(self, user, query_vector, k):
+        if settings.VECTOR_SHARDS <= 1:
+            return super().search(user, query_vector, k)
+        corpus = searchable_chunks(user)
+        stats = corpus_version(corpus)
+        if stats[0] < settings.VECTOR_SHARD_MIN_VECTORS:
+            return self.search_corpus(user, corpus, query_vector, k, stats=stats)
+
+        documents = Document.objects.filter(owner=user, processed=True)
+        shards = set(documents.values_list('shard', flat=True).distinct())
+        if not shards <= set(range(settings.VECTOR_SHARDS)):
+            # Documents indexed before sharding was enabled, or after VECTOR_SHARDS shrank.
+            rebalance_shards(user.pk)
+            shards = set(documents.values_list('shard', flat=True).distinct())
+
+        query = [float(value) for value in query_vector]
+        results = group(
+            current_app.signature(
+                'chatbot.tasks.search_shard', args=[user.pk, shard, query, k], queue=shard_queue(shard)
+            )
+            for shard in sorted(shards)
+        ).apply_async()
+        # The shard queues are served by their own workers, so waiting here cannot deadlock.
+        per_shard = results.get(timeout=settings.VECTOR_SHARD_SEARCH_TIMEOUT, disable_sync_subtasks=False)
+        return heapq.nsmallest(k, (row for rows in per_shard for row in rows), key=lambda row: row['distance'])
+
+    def search_shard(self, user, shard, query_vector, k):
+        """Search one shard; rows carry only ``RESULT_FIELDS`` and ``distance`` so they serialize."""
+        corpus = searchable_chunks(user).filter(document__shard=shard)
+        return [
+            dict({field: row[field] for field in RESULT_FIELDS}, distance=row['distance'])
+            for row in self.search_corpus(user, corpus, query_vector, k, shard=shard)
+        ]
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import uuid
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.utils.deconstruct import deconstructible
+
+
+class HashingFileUploadHandler(TemporaryFileUploadHandler):
+    """Stream every upload to a temporary file, computing its SHA-256 on the way.
+
+    Replaces Django's default handlers so uploads are never held in memory;
+    the digest is attached to the uploaded file as ``sha256``.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256 = self.hasher.hexdigest()
+        return file
+
+
+@deconstructible(path='chatbot.storage.ContentAddressedStorage')
+class ContentAddressedStorage(FileSystemStorage):
+    """Store files under ``blobs/<xx>/<sha256><ext>`` so identical uploads share one file.
+
+    Saving content that is already stored just returns the existing name.
+    Every save records a reference in ``FileBlob``, which deletes the file
+    once the last document using it lets go.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # The final name depends on the content and is chosen in _save.
+        return name
+
+    def _save(self, name, content):
+        from .models import FileBlob
+
+        extension = os.path.splitext(name)[1].lower()
+        digest = getattr(content, 'sha256', None)
+        tmp_path = None
+        if digest is None:
+            # Hash while writing, then move the file to where its digest says.
+            tmp_path = self._tmp_path()
+            digest = self._write(content, tmp_path)
+        target = self._blob_name(digest, extension)
+
+        # Take the reference before looking for the file: its row lock keeps a concurrent
+        # release from deleting an existing file between here and the caller's commit.
+        FileBlob.acquire(target, content.size)
+        if self.exists(target):
+            if tmp_path is not None:
+                os.remove(tmp_path)
+            return target
+        if tmp_path is None:
+            tmp_path = self._tmp_path()
+            if hasattr(content, 'temporary_file_path'):
+                file_move_safe(content.temporary_file_path(), tmp_path)
+            else:
+                self._write(content, tmp_path)
+
+        if self.file_permissions_mode is not None:
+            os.chmod(tmp_path, self.file_permissions_mode)
+        path = self.path(target)
+        os.makedirs(os.path.dirname(path), exist_ok=True, mode=self.directory_permissions_mode or 0o777)
+        # A concurrent upload of the same content writes identical bytes, so either one may win.
+        os.replace(tmp_path, path)
+        return target
+
+    def _blob_name(self, digest, extension):
+        return f'blobs/{digest[:2]}/{digest}{extension}'
+
+    def _tmp_path(self):
+        directory = self.path('blobs')
+        os.makedirs(directory, exist_ok=True, mode=self.directory_permissions_mode or 0o777)
+        return os.path.join(directory, f'{uuid.uuid4().hex}.tmp')
+
+    def _write(self, content, path):
+        hasher = hashlib.sha256()
+        with open(path, 'wb') as f:
+            for chunk in content.chunks():
+                hasher.update(chunk)
+                f.write(chunk)
+        return hasher.hexdigest()
+
+
+def sha256_from_name(name):
+    """Digest of a file stored by :class:`ContentAddressedStorage`, or ``None`` for other names."""
+    if not name.startswith('blobs/'):
+        return None
+    return os.path.splitext(os.path.basename(name))[0]
+
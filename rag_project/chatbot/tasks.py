@@ -1,16 +1,21 @@
 from celery import shared_task
+import hashlib
 import os
-import numpy as np
-import faiss
-import pickle
+from collections import defaultdict
+from contextlib import contextmanager
 from django.conf import settings
+from django.contrib.auth import get_user_model
 
-from .models import ChatMessage, ChatSession, Document, Embedding
+from .models import ChatMessage, ChatSession, Document, Embedding, FileBlob
+from .parsing import SPLIT_VERSION, dump_chunks, load_chunks, split_file
+from .admission import coalesce, coalesce_key, get_redis, llm_slot, release
+from .events import publish
+from .retrieval import corpus_version, get_backend, searchable_chunks
+from .serializers import ChatMessageSerializer
+from .vector_store import compact_user_vectors
 
 from langchain_ollama import OllamaEmbeddings
 from langchain_community.llms import Ollama
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 from chatbot.models import ChatMessage, ChatSession, Document, Embedding
 
@@ -24,139 +29,275 @@ def process_document(self, document_id):
         print(f"Document with id {document_id} does not exist")
         return
 
+    file_name = document.file.name
     try:
-        loader_class = {
-            'pdf': PyPDFLoader,
-            'docx': Docx2txtLoader,
-            'txt': TextLoader
-        }.get(document.file_type)
-
-        if loader_class is None:
-            raise ValueError(f"Unsupported file type: {document.file_type}")
+        chunks = _split_document(document)
+        if _store_chunks(document, file_name, chunks) is None:
+            return f"Skipped {document.title}: its file was replaced"
+        return f"Processed {document.title} ({len(chunks)} chunks)"
 
-        loader = loader_class(document.file.path)
+    except Exception as e:
+        # Left alone if the file was replaced meanwhile: its reindex owns the flag now.
+        Document.objects.filter(pk=document.pk, file=file_name).update(processed=False)
+        raise self.retry(exc=e, countdown=60)
 
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = text_splitter.split_documents(loader.load())
 
-        if not chunks:
-            raise ValueError("No text chunks were created from the document.")
+@shared_task(bind=True)
+def process_document_batch(self, document_ids):
+    """Index several small documents with one embedding request.
+
+    A document that cannot be split is handed to ``process_document`` so it
+    gets retried on its own without holding back the rest of the batch.
+    """
+    documents, chunk_lists = [], []
+    for document in Document.objects.filter(id__in=document_ids, processed=False):
+        try:
+            chunks = _split_document(document)
+        except Exception as e:
+            print(f"Could not split {document.title}, processing it separately: {e!r}")
+            process_document.delay(document.id)
+            continue
+        documents.append(document)
+        chunk_lists.append(chunks)
+
+    if not documents:
+        return "Nothing to process"
 
+    try:
         embeddings_model = OllamaEmbeddings(model="mistral")
-        embeddings = []
+        embeddings = embeddings_model.embed_documents(
+            [chunk.page_content for chunks in chunk_lists for chunk in chunks]
+        )
+        start = 0
+        for document, chunks in zip(documents, chunk_lists):
+            _store_chunks(document, document.file.name, chunks, embeddings[start:start + len(chunks)])
+            start += len(chunks)
+        return f"Processed {len(documents)} documents ({start} chunks)"
+
+    except Exception as e:
+        # Documents already stored are marked processed and skipped on retry.
+        raise self.retry(exc=e, countdown=60)
+
+
+def _split_document(document):
+    """Split the document's file, reusing the chunks cached for identical content."""
+    blob = FileBlob.objects.filter(name=document.file.name).first()
+    if blob is not None and blob.chunks is not None and blob.split_version == SPLIT_VERSION:
+        chunks = load_chunks(blob.chunks)
+    else:
+        chunks = split_file(document.file.path, document.file_type)
+        if blob is not None:
+            FileBlob.objects.filter(pk=blob.pk).update(split_version=SPLIT_VERSION, chunks=dump_chunks(chunks))
+    if not chunks:
+        raise ValueError("No text chunks were created from the document.")
+    return chunks
+
+
+def _embed_chunks(chunks):
+    embeddings_model = OllamaEmbeddings(model="mistral")
+    return [embeddings_model.embed_query(chunk.page_content) for chunk in chunks]
+
+
+def _chunk_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+@contextmanager
+def _indexing_lock(document_id):
+    """Hold the lock every task storing ``document_id``'s chunks takes, across all workers."""
+    with get_redis().lock(f'index:document:{document_id}', timeout=settings.DOCUMENT_INDEX_LOCK_TIMEOUT):
+        yield
+
+
+def _store_chunks(document, file_name, chunks, embeddings=None):
+    """Make ``document``'s stored chunks those split from ``file_name`` and mark it processed.
+
+    Chunks already stored are matched by content hash and keep their
+    ``Embedding`` rows (and the chat references pointing at them); only new
+    chunks are embedded, unless ``embeddings`` (one per chunk) are given,
+    and only vanished ones are removed. Returns the numbers of new, removed
+    and kept chunks, or ``None`` without storing anything when the document
+    was deleted or its file replaced since it was split: the task queued for
+    the replacement indexes that.
+    """
+    with _indexing_lock(document.id):
+        if Document.objects.filter(pk=document.pk).values_list('file', flat=True).first() != file_name:
+            return None
+
+        existing = defaultdict(list)
+        for emb in document.embeddings.only('id', 'text_chunk', 'chunk_index'):
+            existing[_chunk_hash(emb.text_chunk)].append(emb)
+
+        moved = []
+        new_indexes = []
         for i, chunk in enumerate(chunks):
-            embedding = embeddings_model.embed_query(chunk.page_content)
-            embeddings.append(embedding)
-
-            Embedding.objects.create(
-                document=document,
-                embedding=pickle.dumps(embedding),
-                text_chunk=chunk.page_content,
-                chunk_index=i
-            )
-
-        # We no longer save individual FAISS indices for each document
-        # since we'll build a unified index at query time
-        
-        document.processed = True
-        document.save()
-        return f"Processed {document.title} ({len(chunks)} chunks)"
+            matches = existing.get(_chunk_hash(chunk.page_content))
+            if matches:
+                emb = matches.pop(0)
+                if emb.chunk_index != i:
+                    emb.chunk_index = i
+                    moved.append(emb)
+            else:
+                new_indexes.append(i)
+        stale = [emb for embs in existing.values() for emb in embs]
+
+        backend = get_backend()
+        if new_indexes:
+            new_chunks = [chunks[i] for i in new_indexes]
+            if embeddings is None:
+                vectors = _embed_chunks(new_chunks)
+            else:
+                vectors = [embeddings[i] for i in new_indexes]
+            backend.add(document, new_chunks, vectors, chunk_indexes=new_indexes)
+        Embedding.objects.bulk_update(moved, ['chunk_index'], batch_size=500)
+        if stale:
+            backend.remove(stale)
+
+        # Only the flag: a full save would write back a file this instance may no longer have.
+        Document.objects.filter(pk=document.pk).update(processed=True)
+        return len(new_indexes), len(stale), len(chunks) - len(new_indexes)
+
+
+@shared_task(bind=True)
+def reindex_document(self, document_id):
+    """Re-split a replaced document file and embed only the chunks that changed.
+
+    Also indexes a document whose first processing has not finished: a
+    ``process_document`` still running for the old file drops its result.
+    """
+    try:
+        document = Document.objects.get(id=document_id)
+    except Document.DoesNotExist:
+        print(f"Document with id {document_id} does not exist")
+        return
+
+    file_name = document.file.name
+    try:
+        chunks = _split_document(document)
+        stored = _store_chunks(document, file_name, chunks)
+        if stored is None:
+            return f"Skipped {document.title}: its file was replaced again"
+        new, removed, kept = stored
+        return f"Reindexed {document.title}: {new} new, {removed} removed, {kept} kept"
 
     except Exception as e:
-        document.processed = False
-        document.save()
         raise self.retry(exc=e, countdown=60)
 
 
 @shared_task
-def generate_chat_response(session_id, message_id):
-    """Generate AI response using RAG with Ollama."""
+def generate_chat_response(session_id, message_id, ticket=None):
+    """Generate AI response using RAG with Ollama.
+
+    Identical questions against the same corpus that arrive while an answer
+    is being generated share that answer instead of calling Ollama again.
+    """
     try:
         message = ChatMessage.objects.get(id=message_id)
         session = ChatSession.objects.get(id=session_id)
 
-        embeddings_model = OllamaEmbeddings(model="mistral")
-        query_embedding = embeddings_model.embed_query(message.message)
-
-        # Collect all embeddings for this user's documents
-        embeddings_data = []
-        all_embeddings = []
-
-        for doc in Document.objects.filter(owner=session.user, processed=True):
-            for emb in Embedding.objects.filter(document=doc):
-                embedding = pickle.loads(emb.embedding)
-                all_embeddings.append(embedding)
-                embeddings_data.append({
-                    'text': emb.text_chunk,
-                    'embedding': embedding,
-                    'document': doc.title,
-                    'embedding_id': emb.id
-                })
-
-        if not all_embeddings:
-            return "Please upload and process documents first."
-
-        # Create FAISS index
-        dimension = len(all_embeddings[0])
-        np_embeddings = np.array(all_embeddings).astype('float32')
-
-        n_vectors = len(np_embeddings)
-        nlist = min(100, max(1, int(n_vectors ** 0.5)))
-
-        quantizer = faiss.IndexFlatL2(dimension)
-        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
-
-        if not index.is_trained:
-            index.train(np_embeddings)
-        index.add(np_embeddings)
-
-        k = min(10, len(np_embeddings))  # Increased from 3 to 10
-        _, indices_found = index.search(np.array([query_embedding]).astype('float32'), k=k)
-
-        # Diversity filtering: include only one chunk per document
-        seen_docs = set()
-        selected_chunks = []
-        for i in indices_found[0]:
-            if i >= len(embeddings_data):
-                continue
-            doc_title = embeddings_data[i]['document']
-            if doc_title not in seen_docs:
-                selected_chunks.append(embeddings_data[i])
-                seen_docs.add(doc_title)
-            if len(selected_chunks) >= 3:  # limit to 3 diverse chunks
-                break
-
-        context = "\n\n".join(
-            f"From {chunk['document']}:\n{chunk['text']}"
-            for chunk in selected_chunks
+        count, version = corpus_version(searchable_chunks(session.user))
+        if not count:
+            notice = "Please upload and process documents first."
+            publish(session_id, 'error', detail=notice)
+            return notice
+
+        def answer():
+            with llm_slot():
+                return _answer_question(
+                    session.user, message.message,
+                    on_token=lambda text: publish(session_id, 'token', text=text)
+                )
+
+        result = coalesce(coalesce_key(session.user_id, version, message.message), answer)
+
+        response_message = ChatMessage.objects.create(
+            session=session,
+            message=result['text'],
+            is_user=False
         )
 
-        llm = Ollama(model="mistral")
-        prompt = f"""Use the following context to answer the user's question.
+        response_message.references.add(
+            *Embedding.objects.filter(id__in=result['embedding_ids'])
+        )
+        publish(session_id, 'message', message=ChatMessageSerializer(response_message).data)
+
+        return response_message.message
+
+    except Exception as e:
+        error = f"Error generating response: {str(e)}"
+        try:
+            publish(session_id, 'error', detail=error)
+        except Exception:
+            pass
+        return error
+    finally:
+        if ticket:
+            release(ticket)
+
+
+def _answer_question(user, question, on_token):
+    """Retrieve context for ``question`` and ask the LLM; returns the answer text and the chunk ids used.
+
+    ``on_token`` is called with each piece of the answer as the LLM streams it.
+    """
+    embeddings_model = OllamaEmbeddings(model="mistral")
+    query_embedding = embeddings_model.embed_query(question)
+
+    results = get_backend().search(user, query_embedding, k=10)
+
+    # Diversity filtering: include only one chunk per document
+    seen_docs = set()
+    selected_chunks = []
+    for result in results:
+        doc_title = result['document__title']
+        if doc_title not in seen_docs:
+            selected_chunks.append(result)
+            seen_docs.add(doc_title)
+        if len(selected_chunks) >= 3:  # limit to 3 diverse chunks
+            break
+
+    context = "\n\n".join(
+        f"From {chunk['document__title']}:\n{chunk['text_chunk']}"
+        for chunk in selected_chunks
+    )
+
+    llm = Ollama(model="mistral")
+    prompt = f"""Use the following context to answer the user's question.
 If you don't know the answer, just say you don't know, don't try to make up an answer.
 
 Context:
 {context}
 
-Question: {message.message}"""
+Question: {question}"""
 
-        response_text = llm.invoke(prompt)
+    tokens = []
+    for token in llm.stream(prompt):
+        tokens.append(token)
+        on_token(token)
 
-        response_message = ChatMessage.objects.create(
-            session=session,
-            message=response_text,
-            is_user=False
-        )
+    return {
+        'text': ''.join(tokens),
+        'embedding_ids': [chunk['id'] for chunk in selected_chunks],
+    }
 
-        for chunk in selected_chunks:
-            try:
-                response_message.references.add(
-                    Embedding.objects.get(id=chunk['embedding_id'])
-                )
-            except Embedding.DoesNotExist:
-                continue
 
-        return response_message.message
+@shared_task
+def search_shard(user_id, shard, query_vector, k):
+    """Search one retrieval shard of a user's corpus; routed to that shard's queue."""
+    user = get_user_model().objects.get(pk=user_id)
+    return get_backend().search_shard(user, shard, query_vector, k)
 
-    except Exception as e:
-        return f"Error generating response: {str(e)}"
+
+@shared_task
+def rebalance_vector_shards(user_id):
+    moved = get_backend().rebalance(user_id)
+    return f"Moved {moved} documents between shards"
+
+
+@shared_task
+def compact_vector_segments():
+    """Reclaim space left in vector segments by deleted embeddings."""
+    reclaimed = 0
+    for user_id in Document.objects.values_list('owner_id', flat=True).distinct():
+        reclaimed += compact_user_vectors(user_id)
+    return f"Reclaimed {reclaimed} vector rows"
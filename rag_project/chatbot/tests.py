@@ -0,0 +1,790 @@
+import os
+import pickle
+import tempfile
+import time
+import zipfile
+from contextlib import ExitStack
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from rest_framework.authtoken.models import Token
+
+from .models import ChatMessage, ChatSession, Document, Embedding, FileBlob
+from .uploads import collect_uploads
+
+
+class GraphQLValidationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', password='secret')
+        cls.token = Token.objects.create(user=cls.user)
+        document = Document.objects.create(owner=cls.user, title='doc', file='documents/doc.txt', processed=True)
+        embedding = Embedding.objects.create(document=document, text_chunk='chunk', chunk_index=0, vector_offset=0)
+        session = ChatSession.objects.create(user=cls.user, title='session')
+        message = ChatMessage.objects.create(session=session, message='answer', is_user=False)
+        message.references.add(embedding)
+
+    def query(self, query):
+        return self.client.post(
+            '/graphql/', {'query': query}, content_type='application/json',
+            HTTP_AUTHORIZATION=f'Token {self.token.key}',
+        )
+
+    def test_unknown_field_is_rejected(self):
+        response = self.query('{ documents { id embedding } }')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Cannot query field 'embedding'", response.json()['errors'][0]['message'])
+
+    def test_unknown_argument_is_rejected(self):
+        response = self.query('{ chatMessages(sessionId: 1, limit: 5) { id } }')
+        self.assertEqual(response.status_code, 400)
+
+    def test_full_nested_query_is_allowed(self):
+        response = self.query('''{ chatSessions { id title createdAt messages { id message isUser createdAt
+            references { id textChunk chunkIndex createdAt document { id title file fileType uploadedAt processed
+            embeddings { id textChunk chunkIndex createdAt } } } } } }''')
+        self.assertEqual(response.status_code, 200, response.content)
+        session = response.json()['data']['chatSessions'][0]
+        self.assertEqual(session['messages'][0]['references'][0]['document']['embeddings'][0]['textChunk'], 'chunk')
+
+    def test_one_more_list_level_is_rejected(self):
+        response = self.query('''{ chatSessions { id title createdAt messages { id message isUser createdAt
+            references { id textChunk chunkIndex createdAt document { id title file fileType uploadedAt processed
+            embeddings { id textChunk chunkIndex createdAt document { embeddings { id } } } } } } } }''')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('complexity', response.json()['errors'][0]['message'])
+
+
+@mock.patch('chatbot.admission.release')
+@mock.patch('chatbot.admission.admit', return_value='ticket')
+class AdmissionTicketTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.token = Token.objects.create(user=self.user)
+        self.session = ChatSession.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+        publish = mock.patch('chatbot.views.publish')
+        publish.start()
+        self.addCleanup(publish.stop)
+
+    def post_message(self):
+        return self.client.post(
+            f'/api/chat-sessions/{self.session.id}/messages/', {'message': 'hello'},
+            content_type='application/json', **self.auth,
+        )
+
+    def test_ticket_is_released_when_the_message_cannot_be_saved(self, admit, release):
+        with mock.patch('chatbot.serializers.ChatMessageSerializer.save', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.post_message()
+        release.assert_called_once_with('ticket')
+
+    def test_ticket_is_released_when_the_answer_cannot_be_queued(self, admit, release):
+        with mock.patch('chatbot.dispatch.current_app.send_task', side_effect=OSError("broker down")):
+            with self.assertRaises(OSError), self.captureOnCommitCallbacks(execute=True):
+                self.post_message()
+        release.assert_called_once_with('ticket')
+
+    def test_ticket_is_kept_for_the_queued_answer(self, admit, release):
+        with mock.patch('chatbot.dispatch.current_app.send_task') as send_task:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(self.post_message().status_code, 201)
+        self.assertEqual(send_task.call_args.kwargs['args'][2], 'ticket')
+        release.assert_not_called()
+
+    @override_settings(LLM_BUSY_RETRY_AFTER=7)
+    def test_busy_response_tells_the_chat_page_when_to_retry(self, admit, release):
+        admit.return_value = None
+        response = self.post_message()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertIn('busy', response.json()['detail'])
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_graphql_mutation_releases_the_ticket_on_failure(self, admit, release):
+        with mock.patch('chatbot.schema.ChatMessage.objects.create', side_effect=DatabaseError):
+            response = self.client.post(
+                '/graphql/', {'query': f'mutation {{ createChatMessage(sessionId: {self.session.id}, '
+                                       'message: "hello") { chatMessage { id } } }'},
+                content_type='application/json', **self.auth,
+            )
+        self.assertIn('errors', response.json())
+        release.assert_called_once_with('ticket')
+
+
+class StartupImportTests(SimpleTestCase):
+    def test_web_tier_does_not_import_worker_only_modules(self):
+        call_command('bench_startup', repeat=1, stdout=StringIO())
+
+    def test_a_worker_only_import_fails_the_check(self):
+        with mock.patch('chatbot.management.commands.bench_startup.HEAVY_MODULES', ['rest_framework']):
+            with self.assertRaisesMessage(CommandError, 'imported worker-only modules: rest_framework'):
+                call_command('bench_startup', repeat=1, stdout=StringIO())
+
+
+def zip_upload(name, members):
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for member_name, size in members:
+            archive.writestr(member_name, b'a' * size)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='application/zip')
+
+
+@override_settings(BULK_UPLOAD_MAX_FILE_BYTES=1000, BULK_UPLOAD_MAX_BYTES=2500)
+class BulkUploadLimitTests(TestCase):
+    def test_members_over_the_file_limit_are_skipped(self):
+        upload = zip_upload('docs.zip', [('small.txt', 800), ('big.txt', 5000), ('other.txt', 900)])
+        with ExitStack() as stack:
+            files, skipped = collect_uploads([upload], stack)
+        self.assertEqual([file.name for file in files], ['small.txt', 'other.txt'])
+        self.assertEqual(skipped, ['docs.zip/big.txt'])
+
+    def test_request_over_the_total_limit_is_refused_before_storing_anything(self):
+        user = User.objects.create_user('alice')
+        token = Token.objects.create(user=user)
+        # A few hundred bytes compressed, 3600 bytes once expanded.
+        upload = zip_upload('docs.zip', [(f'{i}.txt', 900) for i in range(4)])
+        response = self.client.post(
+            '/api/documents/bulk/', {'files': [upload]}, HTTP_AUTHORIZATION=f'Token {token.key}'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('2500 bytes', response.json()['detail'])
+        self.assertFalse(Document.objects.exists())
+
+
+class FileBlobReferenceTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user('alice')
+        self.storage = Document._meta.get_field('file').storage
+
+    def create_document(self, content):
+        return Document.objects.create(owner=self.user, title='doc', file=SimpleUploadedFile('doc.txt', content))
+
+    def test_replacing_the_file_outside_the_api_releases_the_old_one(self):
+        document = self.create_document(b'first')
+        old_name = document.file.name
+        document.file = SimpleUploadedFile('doc.txt', b'second')
+        with self.captureOnCommitCallbacks(execute=True):
+            document.save()
+        self.assertFalse(self.storage.exists(old_name))
+        self.assertFalse(FileBlob.objects.filter(name=old_name).exists())
+        self.assertEqual(FileBlob.objects.get(name=document.file.name).ref_count, 1)
+
+    def test_replacing_a_shared_file_keeps_it_for_the_other_document(self):
+        document = self.create_document(b'shared')
+        other = self.create_document(b'shared')
+        document.file = SimpleUploadedFile('doc.txt', b'second')
+        with self.captureOnCommitCallbacks(execute=True):
+            document.save()
+        self.assertTrue(self.storage.exists(other.file.name))
+        self.assertEqual(FileBlob.objects.get(name=other.file.name).ref_count, 1)
+
+    def test_stale_instance_keeps_the_file_the_row_now_uses(self):
+        document = self.create_document(b'first')
+        old_name = document.file.name
+        stale = Document.objects.get(pk=document.pk)
+        document.file = SimpleUploadedFile('doc.pdf', b'second')
+        with self.captureOnCommitCallbacks(execute=True):
+            document.save()
+
+        stale.processed = True
+        with self.captureOnCommitCallbacks(execute=True):
+            stale.save()
+        stale.refresh_from_db()
+        self.assertEqual((stale.file.name, stale.file_type, stale.processed), (document.file.name, 'pdf', True))
+        self.assertTrue(self.storage.exists(document.file.name))
+        self.assertEqual(FileBlob.objects.get(name=document.file.name).ref_count, 1)
+        self.assertFalse(FileBlob.objects.filter(name=old_name).exists())
+
+    def test_assigning_a_stored_name_takes_a_reference(self):
+        name = self.create_document(b'shared').file.name
+        other = self.create_document(b'other')
+        other.file = name
+        with self.captureOnCommitCallbacks(execute=True):
+            other.save()
+        self.assertEqual(FileBlob.objects.get(name=name).ref_count, 2)
+
+    def test_assigning_a_deleted_file_fails_clearly(self):
+        document = self.create_document(b'first')
+        name = document.file.name
+        with self.captureOnCommitCallbacks(execute=True):
+            document.delete()
+        other = self.create_document(b'other')
+        other.file = name
+        with self.assertRaisesMessage(ValidationError, 'is no longer stored'):
+            other.save()
+
+    def test_identical_upload_keeps_a_file_whose_release_is_committing(self):
+        name = self.create_document(b'content').file.name
+        with self.captureOnCommitCallbacks() as callbacks:
+            Document.objects.get().delete()
+
+        exists = self.storage.exists
+
+        def exists_then_commit_release(path):
+            # The release commits right after the upload found the file.
+            found = exists(path)
+            for callback in callbacks:
+                callback()
+            return found
+
+        with mock.patch.object(self.storage, 'exists', side_effect=exists_then_commit_release):
+            document = self.create_document(b'content')
+        self.assertEqual(document.file.name, name)
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(FileBlob.objects.get(name=name).ref_count, 1)
+
+
+@override_settings(CHAT_EVENTS_KEEPALIVE=0.05)
+class SessionEventsTests(TestCase):
+    def setUp(self):
+        import fakeredis
+
+        self.user = User.objects.create_user('alice')
+        self.token = Token.objects.create(user=self.user)
+        self.session = ChatSession.objects.create(user=self.user)
+        self.url = f'/api/chat-sessions/{self.session.id}/events/'
+        self.auth = {'AUTHORIZATION': f'Token {self.token.key}'}
+        server = fakeredis.FakeServer()
+        for patcher in [
+            mock.patch('chatbot.admission._client', fakeredis.FakeRedis(server=server)),
+            mock.patch('redis.asyncio.Redis.from_url', return_value=fakeredis.FakeAsyncRedis(server=server)),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_wsgi_requests_are_refused(self):
+        response = self.client.get(self.url, HTTP_AUTHORIZATION=self.auth['AUTHORIZATION'])
+        self.assertEqual(response.status_code, 501)
+
+    async def test_credentials_are_required(self):
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, 401)
+
+    async def test_other_users_sessions_are_not_found(self):
+        other = await ChatSession.objects.acreate(user=await User.objects.acreate(username='bob'))
+        response = await self.async_client.get(f'/api/chat-sessions/{other.id}/events/', headers=self.auth)
+        self.assertEqual(response.status_code, 404)
+
+    async def test_published_tokens_arrive_as_data_frames(self):
+        from .events import publish
+
+        response = await self.async_client.get(self.url, headers=self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        frames = aiter(response.streaming_content)
+        try:
+            self.assertEqual(await anext(frames), b'retry: 3000\n\n')
+            self.assertEqual(await anext(frames), b': keep-alive\n\n')
+            publish(self.session.id, 'token', text='Hel')
+            frame = await anext(frames)
+        finally:
+            await frames.aclose()
+        self.assertEqual(frame, b'data: {"type": "token", "text": "Hel"}\n\n')
+
+
+def use_temporary_vector_store(test):
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    settings_override = override_settings(
+        VECTOR_STORE_PATH=os.path.join(directory.name, 'vectors'),
+        FAISS_INDEX_PATH=os.path.join(directory.name, 'indexes'),
+        VECTOR_PROJECTION_VERSION=0,
+    )
+    settings_override.enable()
+    test.addCleanup(settings_override.disable)
+
+
+class VectorSegmentTests(SimpleTestCase):
+    def setUp(self):
+        use_temporary_vector_store(self)
+
+    def test_append_drops_partial_trailing_row(self):
+        from .vector_store import VectorSegment
+
+        segment = VectorSegment(1)
+        first = np.arange(12, dtype='float32').reshape(3, 4)
+        self.assertEqual(segment.append(first), [0, 1, 2])
+        with open(segment.path, 'ab') as f:
+            f.write(b'\x01\x02\x03')  # A writer crashed mid-row.
+
+        self.assertEqual(segment.append(first + 100), [3, 4, 5])
+        np.testing.assert_array_equal(segment.vectors()[3:], first + 100)
+
+
+class VectorCompactionTests(TestCase):
+    def setUp(self):
+        from .vector_store import VectorSegment
+
+        use_temporary_vector_store(self)
+        self.user = User.objects.create_user('alice')
+        self.segment = VectorSegment(self.user.pk)
+        self.vectors = np.arange(24, dtype='float32').reshape(6, 4)
+        document = Document.objects.create(owner=self.user, title='doc', file='documents/doc.txt', processed=True)
+        self.embeddings = [
+            Embedding.objects.create(document=document, text_chunk=str(i), chunk_index=i, vector_offset=offset)
+            for i, offset in enumerate(self.segment.append(self.vectors))
+        ]
+        Embedding.objects.filter(id__in=[self.embeddings[0].id, self.embeddings[3].id]).delete()
+
+    def assert_offsets_find_their_vectors(self):
+        from .vector_store import VectorSegment
+
+        segment = VectorSegment(self.user.pk)
+        with segment.lock:
+            rows = dict(Embedding.objects.values_list('text_chunk', 'vector_offset'))
+            stored = segment.vectors()
+            for text, offset in rows.items():
+                np.testing.assert_array_equal(stored[offset], self.vectors[int(text)])
+        self.assertFalse(segment.compacted_path.exists())
+
+    def test_compaction_moves_offsets_and_generation_together(self):
+        from .vector_store import compact_user_vectors
+
+        self.assertEqual(compact_user_vectors(self.user.pk, force=True), 2)
+        self.assertEqual(len(self.segment), 4)
+        self.assertEqual(self.segment.generation, 1)
+        self.assertEqual(self.segment.committed_generation(), 1)
+        self.assert_offsets_find_their_vectors()
+
+    def test_copy_committed_before_a_crash_is_swapped_in(self):
+        from .vector_store import compact_user_vectors
+
+        with mock.patch('chatbot.vector_store.os.replace', side_effect=OSError("killed")):
+            with self.assertRaises(OSError):
+                compact_user_vectors(self.user.pk, force=True)
+        self.assertTrue(self.segment.compacted_path.exists())
+        self.assert_offsets_find_their_vectors()
+        self.assertEqual(len(self.segment), 4)
+
+    def test_copy_not_committed_before_a_crash_is_discarded(self):
+        from .vector_store import compact_user_vectors
+
+        with mock.patch('chatbot.vector_store.VectorSegmentState.objects.update_or_create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                compact_user_vectors(self.user.pk, force=True)
+        self.assertTrue(self.segment.compacted_path.exists())
+        self.assert_offsets_find_their_vectors()
+        self.assertEqual(len(self.segment), 6)
+
+    def test_format_1_segments_are_read_and_rewritten_in_format_2(self):
+        from .vector_store import HEADER, HEADER_V1, MAGIC, compact_user_vectors
+
+        with open(self.segment.path, 'wb') as f:
+            f.write(HEADER_V1.pack(MAGIC, 1, 4, 0) + self.vectors.tobytes())
+        self.assertEqual((len(self.segment), self.segment.generation), (6, 0))
+        self.assert_offsets_find_their_vectors()
+
+        compact_user_vectors(self.user.pk, force=True)
+        self.assertEqual(self.segment.path.stat().st_size, HEADER.size + 4 * 4 * 4)
+        self.assert_offsets_find_their_vectors()
+
+
+def use_fake_redis(test):
+    import fakeredis
+
+    client = mock.patch('chatbot.admission._client', fakeredis.FakeRedis())
+    client.start()
+    test.addCleanup(client.stop)
+
+
+class DocumentIndexingTests(TestCase):
+    """Chunks are the file's text split on "|"; embedding a chunk is recorded and faked."""
+
+    def setUp(self):
+        from . import tasks
+
+        use_temporary_vector_store(self)
+        use_fake_redis(self)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.tasks = tasks
+        self.embedded = []
+        for target, fake in [('_split_document', self.split), ('_embed_chunks', self.embed)]:
+            patcher = mock.patch.object(tasks, target, side_effect=fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user('alice')
+        self.token = Token.objects.create(user=self.user)
+        self.document = Document.objects.create(owner=self.user, title='doc', file=self.upload('a|b|c'))
+
+    def upload(self, text):
+        return SimpleUploadedFile('doc.txt', text.encode())
+
+    def split(self, document):
+        with document.file.open('rb') as f:
+            return [SimpleNamespace(page_content=text) for text in f.read().decode().split('|')]
+
+    def embed(self, chunks):
+        self.embedded.extend(chunk.page_content for chunk in chunks)
+        return [[float(ord(chunk.page_content[0])), 0.0, 0.0, 1.0] for chunk in chunks]
+
+    def replace_file(self, text):
+        with mock.patch('chatbot.dispatch.current_app.send_task') as send_task:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.patch(
+                    f'/api/documents/{self.document.id}/',
+                    encode_multipart(BOUNDARY, {'file': self.upload(text)}),
+                    content_type=MULTIPART_CONTENT, HTTP_AUTHORIZATION=f'Token {self.token.key}',
+                )
+        self.assertEqual(response.status_code, 200, response.content)
+        return send_task
+
+    def stored_chunks(self):
+        return list(self.document.embeddings.order_by('chunk_index').values_list('chunk_index', 'text_chunk'))
+
+    def test_reindex_embeds_only_new_chunks_and_keeps_references(self):
+        self.tasks.process_document(self.document.id)
+        kept = self.document.embeddings.get(text_chunk='b')
+        message = ChatMessage.objects.create(
+            session=ChatSession.objects.create(user=self.user), message='answer', is_user=False
+        )
+        message.references.add(kept)
+
+        send_task = self.replace_file('b|c|d')
+        send_task.assert_called_once_with('chatbot.tasks.reindex_document', args=[self.document.id])
+        self.embedded.clear()
+        self.assertEqual(
+            self.tasks.reindex_document(self.document.id),
+            "Reindexed doc: 1 new, 1 removed, 2 kept",
+        )
+        self.assertEqual(self.embedded, ['d'])
+        self.assertEqual(self.stored_chunks(), [(0, 'b'), (1, 'c'), (2, 'd')])
+        self.assertEqual(list(message.references.all()), [kept])
+
+    def test_a_second_reindex_adds_nothing(self):
+        self.tasks.process_document(self.document.id)
+        self.replace_file('c|d')
+        self.tasks.reindex_document(self.document.id)
+        self.assertEqual(
+            self.tasks.reindex_document(self.document.id),
+            "Reindexed doc: 0 new, 0 removed, 2 kept",
+        )
+        self.assertEqual(self.stored_chunks(), [(0, 'c'), (1, 'd')])
+
+    def test_processing_of_a_replaced_file_drops_its_chunks(self):
+        split = self.split
+
+        def replaced_while_splitting(document):
+            chunks = split(document)
+            self.replace_file('x|y')
+            return chunks
+
+        with mock.patch.object(self.tasks, '_split_document', side_effect=replaced_while_splitting):
+            self.assertEqual(
+                self.tasks.process_document(self.document.id), "Skipped doc: its file was replaced"
+            )
+        self.assertEqual(self.stored_chunks(), [])
+        self.assertEqual(self.tasks.reindex_document(self.document.id), "Reindexed doc: 2 new, 0 removed, 0 kept")
+        self.assertEqual(self.stored_chunks(), [(0, 'x'), (1, 'y')])
+
+    def test_chunks_of_a_stale_instance_are_dropped(self):
+        stale = Document.objects.get(pk=self.document.pk)
+        chunks = self.split(stale)
+        self.replace_file('x|y')
+        self.assertIsNone(self.tasks._store_chunks(stale, stale.file.name, chunks))
+        self.document.refresh_from_db()
+        self.assertNotEqual(self.document.file.name, stale.file.name)
+        self.assertFalse(self.document.processed)
+        self.assertEqual(self.stored_chunks(), [])
+
+    def test_batch_stores_the_embeddings_it_computed(self):
+        other = Document.objects.create(owner=self.user, title='other', file=self.upload('d|e'))
+        with mock.patch.object(self.tasks, 'OllamaEmbeddings') as model:
+            model.return_value.embed_documents.side_effect = lambda texts: [[1.0, 0.0, 0.0, 0.0] for _ in texts]
+            self.tasks.process_document_batch([self.document.id, other.id])
+        self.assertEqual(self.embedded, [])
+        self.assertEqual(self.stored_chunks(), [(0, 'a'), (1, 'b'), (2, 'c')])
+        self.assertEqual(Document.objects.filter(processed=True).count(), 2)
+
+    def test_unprocessed_document_with_a_new_file_is_indexed(self):
+        send_task = self.replace_file('x|y')
+        send_task.assert_called_once_with('chatbot.tasks.reindex_document', args=[self.document.id])
+        self.tasks.reindex_document(self.document.id)
+        self.document.refresh_from_db()
+        self.assertTrue(self.document.processed)
+        self.assertEqual(self.stored_chunks(), [(0, 'x'), (1, 'y')])
+
+
+class ProjectionTests(TestCase):
+    def setUp(self):
+        from .projection import load_projection
+
+        use_temporary_vector_store(self)
+        load_projection.cache_clear()
+        self.addCleanup(load_projection.cache_clear)
+        self.raw = np.random.default_rng(0).standard_normal((64, 16)).astype('float32')
+        self.user = User.objects.create_user('alice')
+
+    def train(self):
+        from .projection import Projection
+
+        return Projection.train(self.raw, 'pca', 4)
+
+    def store(self, vectors):
+        """Store ``vectors`` as chunks "0", "1", ... of one processed document and return its embeddings."""
+        from .retrieval import FaissBackend
+
+        document = Document.objects.create(owner=self.user, title='doc', file='documents/doc.txt', processed=True)
+        chunks = [SimpleNamespace(page_content=str(i)) for i in range(len(vectors))]
+        return FaissBackend().add(document, chunks, vectors)
+
+    def assert_rows_match(self, expected):
+        """Row ``vector_offset`` of every live embedding ``i`` holds ``expected[i]``."""
+        from .vector_store import VectorSegment
+
+        segment = VectorSegment(self.user.pk)
+        with segment.lock:
+            for text, offset in Embedding.objects.values_list('text_chunk', 'vector_offset'):
+                np.testing.assert_allclose(segment.vectors()[offset], expected[int(text)], rtol=1e-4, atol=1e-4)
+
+    def test_train_saves_a_version_that_loads_and_applies_the_same(self):
+        from .projection import available_versions, load_projection
+
+        projection = self.train()
+        self.assertEqual((projection.version, projection.d_in, projection.d_out), (1, 16, 4))
+        self.assertEqual(available_versions(), [1])
+        projected = projection.apply(self.raw)
+        self.assertEqual(projected.shape, (64, 4))
+        np.testing.assert_allclose(load_projection(1).apply(self.raw), projected)
+        with self.assertRaises(ValueError):
+            projection.apply(self.raw[:, :8])
+        self.assertEqual(self.train().version, 2)
+
+    def test_opq_needs_enough_vectors(self):
+        from .projection import Projection
+
+        with self.assertRaisesMessage(ValueError, 'at least 256 vectors'):
+            Projection.train(self.raw, 'opq', 4)
+
+    def test_new_segment_stores_rows_in_the_configured_projection(self):
+        from .projection import project
+        from .vector_store import VectorSegment
+
+        self.train()
+        with override_settings(VECTOR_PROJECTION_VERSION=1):
+            self.store(self.raw[:10])
+            segment = VectorSegment(self.user.pk)
+            self.assertEqual((segment.projection, segment.dimension), (1, 4))
+        # The header, not the setting, says how existing rows are stored.
+        self.assertEqual(VectorSegment(self.user.pk).projection, 1)
+        self.assert_rows_match(project(self.raw, 1))
+
+    def test_search_projects_raw_queries_like_the_rows(self):
+        from .retrieval import FaissBackend
+
+        self.train()
+        with override_settings(VECTOR_PROJECTION_VERSION=1):
+            self.store(self.raw)
+        results = FaissBackend().search(self.user, self.raw[5].tolist(), 1)
+        self.assertEqual(results[0]['text_chunk'], '5')
+        self.assertAlmostEqual(results[0]['distance'], 0.0, places=4)
+
+    def test_training_sample_skips_rows_of_deleted_embeddings(self):
+        from .management.commands.project_vectors import Command
+
+        dead = np.full((4, 16), 1e6, dtype='float32')
+        embeddings = self.store(np.concatenate([dead, self.raw]))
+        Embedding.objects.filter(id__in=[embedding.id for embedding in embeddings[:4]]).delete()
+        sample = Command()._training_sample([self.user.pk])
+        self.assertEqual(len(sample), 64)
+        self.assertLess(np.abs(sample).max(), 1e3)
+
+    def test_project_vectors_keeps_offsets_aligned_both_ways(self):
+        from .projection import project
+        from .vector_store import VectorSegment
+
+        embeddings = self.store(self.raw)
+        Embedding.objects.filter(id__in=[embedding.id for embedding in embeddings[::3]]).delete()
+
+        call_command('project_vectors', train='pca', dim=4, stdout=StringIO())
+        self.assertEqual(VectorSegment(self.user.pk).projection, 1)
+        self.assertEqual(len(VectorSegment(self.user.pk)), Embedding.objects.count())
+        self.assert_rows_match(project(self.raw, 1))
+
+        # Projected rows cannot be mapped back; going to raw embeds the chunk texts again.
+        with mock.patch('langchain_ollama.OllamaEmbeddings') as model:
+            model.return_value.embed_documents.side_effect = lambda texts: self.raw[[int(t) for t in texts]]
+            call_command('project_vectors', to=0, stdout=StringIO())
+        self.assertEqual(VectorSegment(self.user.pk).projection, 0)
+        self.assert_rows_match(self.raw)
+
+
+class QuantizedSearchTests(TestCase):
+    def setUp(self):
+        use_temporary_vector_store(self)
+
+    def search_tiny_corpus(self, mode, n_vectors):
+        from .retrieval import FaissBackend
+
+        user = User.objects.create_user(f'{mode}-{n_vectors}')
+        document = Document.objects.create(owner=user, title='doc', file='documents/doc.txt', processed=True)
+        backend = FaissBackend()
+        vectors = np.random.default_rng(0).standard_normal((n_vectors, 32)).astype('float32')
+        chunks = [SimpleNamespace(page_content=f'chunk {i}') for i in range(n_vectors)]
+        embeddings = backend.add(document, chunks, vectors)
+        with override_settings(VECTOR_QUANTIZATION=mode):
+            rows = backend.search(user, vectors[-1], 3)
+        self.assertEqual(rows[0]['id'], embeddings[-1].id)
+
+    def test_users_pinned_to_a_compressed_mode_can_search_tiny_corpora(self):
+        for mode in ('sq8', 'pq'):
+            for n_vectors in (1, 10, 50):
+                with self.subTest(mode=mode, n_vectors=n_vectors):
+                    self.search_tiny_corpus(mode, n_vectors)
+
+
+def _extract_text(page):
+    # Patched in before the pool forks, so it also runs in the pool processes.
+    if page.page_number == 1:
+        time.sleep(60)
+    if page.page_number == 2:
+        raise ValueError("broken content stream")
+    return f'page {page.page_number}'
+
+
+@override_settings(VECTOR_SHARDS=2, VECTOR_SHARD_MIN_VECTORS=3)
+class ShardedSearchTests(TestCase):
+    def setUp(self):
+        from .sharding import ShardedFaissBackend
+
+        self.backend = ShardedFaissBackend()
+        self.user = User.objects.create_user('alice')
+        for shard, processed in [(0, True), (1, True), (1, True), (None, False)]:
+            document = Document.objects.create(
+                owner=self.user, title='doc', file='documents/doc.txt', processed=processed, shard=shard
+            )
+            for index in range(2):
+                Embedding.objects.create(document=document, text_chunk='chunk', chunk_index=index, vector_offset=0)
+
+    def test_fans_out_once_per_shard_of_processed_documents(self):
+        with mock.patch('chatbot.sharding.current_app.signature') as signature, \
+                mock.patch('chatbot.sharding.group') as fan_out:
+            fan_out.return_value.apply_async.return_value.get.return_value = [[], []]
+            # One aggregate over the chunks and one DISTINCT over the documents' shards.
+            with self.assertNumQueries(2):
+                self.backend.search(self.user, [0.0], 5)
+            # group() is mocked, so build the signatures it was handed.
+            list(fan_out.call_args.args[0])
+        self.assertEqual([call.kwargs['args'][1] for call in signature.call_args_list], [0, 1])
+
+    @override_settings(VECTOR_SHARD_MIN_VECTORS=100)
+    def test_small_corpus_is_searched_in_process_with_the_same_count(self):
+        with mock.patch.object(self.backend, 'search_corpus', return_value=[]) as search_corpus:
+            with self.assertNumQueries(1):
+                self.backend.search(self.user, [0.0], 5)
+        self.assertEqual(search_corpus.call_args.kwargs['stats'][0], 6)
+
+
+class PdfPageIsolationTests(SimpleTestCase):
+    def setUp(self):
+        from pypdf import PdfWriter
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'doc.pdf')
+        writer = PdfWriter()
+        for _ in range(4):
+            writer.add_blank_page(width=200, height=200)
+        writer.write(self.path)
+
+    def pages(self):
+        from pypdf import PageObject
+
+        from .parsing import iter_pdf_pages
+
+        with mock.patch.object(PageObject, 'extract_text', _extract_text):
+            return [page.page_content for page in iter_pdf_pages(self.path)]
+
+    @override_settings(PDF_PAGE_TIMEOUT=1, PDF_PARALLEL_MIN_PAGES=8, PDF_PARSE_WORKERS=4)
+    def test_small_pdf_skips_hanging_and_failing_pages(self):
+        started = time.monotonic()
+        self.assertEqual(self.pages(), ['page 0', 'page 3'])
+        self.assertLess(time.monotonic() - started, 30)
+
+    @override_settings(PDF_PAGE_TIMEOUT=1, PDF_PARALLEL_MIN_PAGES=2, PDF_PARSE_WORKERS=2)
+    def test_parallel_pdf_skips_hanging_and_failing_pages(self):
+        self.assertEqual(self.pages(), ['page 0', 'page 3'])
+
+    @override_settings(PDF_PAGE_TIMEOUT=0)
+    def test_in_process_extraction_skips_failing_pages(self):
+        with mock.patch.object(time, 'sleep'):
+            self.assertEqual(self.pages(), ['page 0', 'page 1', 'page 3'])
+
+
+class PgVectorBackendTests(TestCase):
+    """Runs against PostgreSQL with pgvector (set POSTGRES_DB etc.); skipped on other databases."""
+
+    def setUp(self):
+        from .retrieval import PgVectorBackend
+
+        self.backend = PgVectorBackend()
+        if connection.vendor != 'postgresql' or self.backend.table not in connection.introspection.table_names():
+            self.skipTest("needs PostgreSQL with pgvector")
+        use_temporary_vector_store(self)
+        self.rng = np.random.default_rng(0)
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    def document(self, owner, processed=True):
+        return Document.objects.create(owner=owner, title='doc', file='documents/doc.txt', processed=processed)
+
+    def vectors(self, n):
+        return self.rng.standard_normal((n, self.backend.dimensions)).astype('float32')
+
+    def add(self, backend, document, vectors):
+        chunks = [SimpleNamespace(page_content=f'chunk {i}') for i in range(len(vectors))]
+        return backend.add(document, chunks, vectors)
+
+    def test_search_finds_nearest_of_the_owners_processed_chunks(self):
+        vectors = self.vectors(50)
+        embeddings = self.add(self.backend, self.document(self.alice), vectors)
+        self.add(self.backend, self.document(self.bob), vectors)
+        self.add(self.backend, self.document(self.alice, processed=False), vectors)
+
+        rows = self.backend.search(self.alice, vectors[7] + 0.01, 5)
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['id'], embeddings[7].id)
+        self.assertEqual({row['document_id'] for row in rows}, {embeddings[0].document_id})
+        self.assertEqual([row['distance'] for row in rows], sorted(row['distance'] for row in rows))
+
+    def test_remove_drops_vectors(self):
+        embeddings = self.add(self.backend, self.document(self.alice), self.vectors(3))
+        self.backend.remove(embeddings[:1])
+        rows = self.backend.search(self.alice, self.vectors(1)[0], 5)
+        self.assertEqual({row['id'] for row in rows}, {embedding.id for embedding in embeddings[1:]})
+
+    def test_backfill_copies_segment_and_pickled_vectors(self):
+        from .retrieval import FaissBackend
+
+        vectors = self.vectors(20)
+        document = self.document(self.alice)
+        embeddings = self.add(FaissBackend(), document, vectors[:19])
+        legacy = Embedding.objects.create(
+            document=document, text_chunk='legacy', chunk_index=19, embedding=pickle.dumps(vectors[19].tolist())
+        )
+        self.assertEqual(self.backend.search(self.alice, vectors[3], 5), [])
+
+        call_command('backfill_pgvector', stdout=StringIO())
+        call_command('backfill_pgvector', stdout=StringIO())  # Nothing left to copy the second time.
+
+        self.assertEqual(self.backend.search(self.alice, vectors[3], 1)[0]['id'], embeddings[3].id)
+        self.assertEqual(self.backend.search(self.alice, vectors[19], 1)[0]['id'], legacy.id)
@@ -0,0 +1,93 @@
+import os
+import zipfile
+
+from django.conf import settings
+from django.core.files import File
+from rest_framework.exceptions import ValidationError
+
+SUPPORTED_EXTENSIONS = ('pdf', 'docx', 'txt')
+
+
+def _extension(name):
+    return os.path.splitext(name)[1].lstrip('.').lower()
+
+
+def collect_uploads(uploads, stack):
+    """Split ``uploads`` into files to store and names that were skipped.
+
+    Zip archives are expanded. Their members are read from the archive as
+    they are saved to storage rather than extracted first; ``stack`` (an
+    ``ExitStack``) keeps the archives open until the caller is done.
+    Files over ``BULK_UPLOAD_MAX_FILE_BYTES`` are skipped, and a
+    ``ValidationError`` is raised once the files to store add up to more
+    than ``BULK_UPLOAD_MAX_BYTES``, before anything is stored. Zip members
+    are checked by the uncompressed size in their header, which is also as
+    much as reading them can return.
+    """
+    files, skipped = [], []
+    total_bytes = 0
+
+    def accept(name, size):
+        nonlocal total_bytes
+        if size > settings.BULK_UPLOAD_MAX_FILE_BYTES:
+            skipped.append(name)
+            return False
+        total_bytes += size
+        if total_bytes > settings.BULK_UPLOAD_MAX_BYTES:
+            raise ValidationError({
+                'detail': f"The uploaded files add up to more than {settings.BULK_UPLOAD_MAX_BYTES} bytes."
+            })
+        return True
+
+    for upload in uploads:
+        if _extension(upload.name) != 'zip':
+            if _extension(upload.name) not in SUPPORTED_EXTENSIONS:
+                skipped.append(upload.name)
+            elif accept(upload.name, upload.size):
+                files.append(upload)
+            continue
+
+        try:
+            archive = stack.enter_context(zipfile.ZipFile(upload))
+        except zipfile.BadZipFile:
+            skipped.append(upload.name)
+            continue
+        for info in archive.infolist():
+            name = os.path.basename(info.filename)
+            if info.is_dir() or name.startswith('.'):
+                continue
+            member_name = f"{upload.name}/{info.filename}"
+            if _extension(name) not in SUPPORTED_EXTENSIONS:
+                skipped.append(member_name)
+                continue
+            if not accept(member_name, info.file_size):
+                continue
+            member = File(stack.enter_context(archive.open(info)), name=name)
+            member.size = info.file_size
+            files.append(member)
+    return files, skipped
+
+
+def plan_batches(documents):
+    """Group ``(document_id, size)`` pairs into lists of ids, one list per ingestion task.
+
+    Files of ``INGEST_BATCH_MAX_BYTES`` or more get a task of their own;
+    smaller ones share a task up to that many bytes or
+    ``INGEST_BATCH_MAX_DOCUMENTS`` documents.
+    """
+    batches, current, current_bytes = [], [], 0
+    for document_id, size in sorted(documents, key=lambda document: document[1]):
+        if size >= settings.INGEST_BATCH_MAX_BYTES:
+            batches.append([document_id])
+            continue
+        if current and (
+            current_bytes + size > settings.INGEST_BATCH_MAX_BYTES
+            or len(current) >= settings.INGEST_BATCH_MAX_DOCUMENTS
+        ):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(document_id)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
@@ -0,0 +1,67 @@
+from graphql import GraphQLError, ValidationRule
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode
+from graphql.type import GraphQLList, GraphQLNonNull, get_named_type
+
+
+def complexity_limit_validator(max_complexity, list_multiplier=10):
+    """Build a validation rule rejecting operations whose estimated cost exceeds ``max_complexity``.
+
+    Every field costs 1; the cost of the selections under a list field is
+    multiplied by ``list_multiplier`` since it runs once per returned item.
+    """
+
+    class ComplexityLimitRule(ValidationRule):
+        def enter_operation_definition(self, node, *_args):
+            schema = self.context.schema
+            root_type = {
+                'query': schema.query_type,
+                'mutation': schema.mutation_type,
+                'subscription': schema.subscription_type,
+            }.get(node.operation.value)
+            if root_type is None:
+                return
+            complexity = self._selection_cost(root_type, node.selection_set, set())
+            if complexity > max_complexity:
+                name = node.name.value if node.name else 'anonymous'
+                self.report_error(GraphQLError(
+                    f"'{name}' has an estimated complexity of {complexity}, "
+                    f"exceeding the maximum of {max_complexity}.",
+                    node,
+                ))
+
+        def _selection_cost(self, parent_type, selection_set, visited_fragments):
+            if selection_set is None:
+                return 0
+            cost = 0
+            for selection in selection_set.selections:
+                if isinstance(selection, FieldNode):
+                    cost += self._field_cost(parent_type, selection, visited_fragments)
+                elif isinstance(selection, InlineFragmentNode):
+                    fragment_type = parent_type
+                    if selection.type_condition:
+                        fragment_type = self.context.schema.get_type(selection.type_condition.name.value)
+                    cost += self._selection_cost(fragment_type, selection.selection_set, visited_fragments)
+                elif isinstance(selection, FragmentSpreadNode):
+                    name = selection.name.value
+                    fragment = self.context.get_fragment(name)
+                    if fragment is None or name in visited_fragments:
+                        continue
+                    fragment_type = self.context.schema.get_type(fragment.type_condition.name.value)
+                    cost += self._selection_cost(
+                        fragment_type, fragment.selection_set, visited_fragments | {name}
+                    )
+            return cost
+
+        def _field_cost(self, parent_type, field, visited_fragments):
+            field_def = getattr(parent_type, 'fields', {}).get(field.name.value)
+            if field_def is None:
+                return 1
+            field_type = field_def.type
+            if isinstance(field_type, GraphQLNonNull):
+                field_type = field_type.of_type
+            multiplier = list_multiplier if isinstance(field_type, GraphQLList) else 1
+            children = self._selection_cost(get_named_type(field_type), field.selection_set, visited_fragments)
+            return 1 + multiplier * children
+
+    return ComplexityLimitRule
+
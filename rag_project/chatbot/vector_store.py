@@ -0,0 +1,278 @@
+import os
+import pickle
+import struct
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from filelock import FileLock
+
+from .models import Embedding, VectorSegmentState
+from .projection import project
+
+MAGIC = b'RAGV'
+FORMAT_VERSION = 2
+# magic, format version, dimension, projection version (0, as in files from before projections: raw
+# embeddings), compaction generation
+HEADER = struct.Struct('<4sIIII')
+# Format 1 files have no generation; they read as generation 0 and are rewritten in format 2 when compacted.
+HEADER_V1 = struct.Struct('<4sIII')
+
+
+class _SegmentLock:
+    """The segment's file lock; taking it first settles a compaction that was interrupted."""
+
+    def __init__(self, segment):
+        self.segment = segment
+        self.file_lock = FileLock(f'{segment.path}.lock')
+
+    def __enter__(self):
+        self.file_lock.acquire()
+        try:
+            if self.file_lock.lock_counter == 1:
+                self.segment.recover()
+        except BaseException:
+            self.file_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file_lock.release()
+
+
+class VectorSegment:
+    """Append-only float32 vector file for one user, read through a memory map.
+
+    Row ``i`` of the segment is the vector stored at ``Embedding.vector_offset == i``.
+    Rows of deleted embeddings stay in the file until the segment is compacted.
+    All writers, and readers resolving offsets, must hold :attr:`lock`.
+
+    Every row is stored in the segment's :attr:`projection`, fixed when the
+    file is created (``VECTOR_PROJECTION_VERSION``) or rewritten by
+    ``project_vectors``; raw embeddings and queries go through
+    :meth:`project` first.
+
+    Compaction rewrites the file under a new :attr:`generation`, which is
+    committed to ``VectorSegmentState`` together with the new offsets.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.path = Path(settings.VECTOR_STORE_PATH) / f'user_{user_id}.vec'
+        self.lock = _SegmentLock(self)
+
+    def _read_header(self, path=None):
+        """Return ``(dimension, projection, generation, header size)`` of the segment file at ``path``."""
+        path = path or self.path
+        with open(path, 'rb') as f:
+            data = f.read(HEADER.size)
+        if len(data) < HEADER_V1.size or data[:4] != MAGIC:
+            raise ValueError(f"{path} is not a vector segment file")
+        version = HEADER_V1.unpack(data[:HEADER_V1.size])[1]
+        if version == 1:
+            _, _, dimension, projection = HEADER_V1.unpack(data[:HEADER_V1.size])
+            return dimension, projection, 0, HEADER_V1.size
+        if version != FORMAT_VERSION or len(data) < HEADER.size:
+            raise ValueError(f"{path} is not a vector segment file")
+        _, _, dimension, projection, generation = HEADER.unpack(data)
+        return dimension, projection, generation, HEADER.size
+
+    @property
+    def dimension(self):
+        if not self.path.exists():
+            return None
+        return self._read_header()[0]
+
+    @property
+    def projection(self):
+        if not self.path.exists():
+            return settings.VECTOR_PROJECTION_VERSION
+        return self._read_header()[1]
+
+    @property
+    def generation(self):
+        if not self.path.exists():
+            return 0
+        return self._read_header()[2]
+
+    def committed_generation(self):
+        """The generation the ``Embedding`` offsets in the database refer to."""
+        return VectorSegmentState.objects.filter(user_id=self.user_id).values_list('generation', flat=True).first() or 0
+
+    def project(self, vectors):
+        """Map raw embeddings (a 2D array) into the space the segment's rows are stored in."""
+        return project(vectors, self.projection)
+
+    def __len__(self):
+        if not self.path.exists():
+            return 0
+        dimension, _, _, header_size = self._read_header()
+        return (self.path.stat().st_size - header_size) // (dimension * 4)
+
+    def append(self, vectors):
+        """Project the raw embeddings ``vectors``, append them and return the offsets they were written at."""
+        vectors = np.asarray(vectors, dtype='float32')
+        if vectors.ndim != 2 or not len(vectors):
+            raise ValueError("Expected a non-empty 2D array of vectors.")
+        projection = self.projection
+        vectors = np.ascontiguousarray(project(vectors, projection), dtype='<f4')
+        dimension = self.dimension
+        if dimension is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, FORMAT_VERSION, vectors.shape[1], projection, 0))
+            dimension = vectors.shape[1]
+        elif vectors.shape[1] != dimension:
+            raise ValueError(f"Segment stores {dimension}-d vectors, got {vectors.shape[1]}-d.")
+
+        start = len(self)
+        header_size = self._read_header()[3]
+        with open(self.path, 'r+b') as f:
+            # Drop a partial row left by a writer that crashed mid-append, or every later row is misaligned.
+            end = header_size + start * dimension * 4
+            f.truncate(end)
+            f.seek(end)
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        return list(range(start, start + len(vectors)))
+
+    def vectors(self):
+        """Return a read-only memory map over every row in the segment."""
+        count = len(self)
+        if not count:
+            return np.empty((0, self.dimension or 0), dtype='float32')
+        dimension, _, _, header_size = self._read_header()
+        return np.memmap(self.path, dtype='<f4', mode='r', offset=header_size, shape=(count, dimension))
+
+    def take(self, offsets):
+        """Return the rows at ``offsets``, as a zero-copy view when they form a contiguous run."""
+        vectors = self.vectors()
+        if not offsets:
+            return vectors[:0]
+        start = offsets[0]
+        if offsets == list(range(start, start + len(offsets))):
+            return vectors[start:start + len(offsets)]
+        return np.asarray(vectors[offsets])
+
+    @property
+    def compacted_path(self):
+        return self.path.with_suffix('.vec.compact')
+
+    def write_compacted(self, live_offsets, transform=None, projection=None):
+        """Write a copy of the segment keeping only ``live_offsets`` (in that order).
+
+        ``transform(offsets, vectors)`` may replace each batch of rows, for
+        instance to move them to another ``projection``, which the copy's
+        header then records. Returns a mapping of old offset to new offset.
+        The copy only replaces the segment once the caller, still holding the
+        lock, passes the new offsets to :meth:`commit_compacted`.
+        """
+        remap = {old: new for new, old in enumerate(live_offsets)}
+        source = self.vectors()
+        if projection is None:
+            projection = self.projection
+        # Past the database's generation too, in case the segment was deleted and started over.
+        generation = max(self.generation, self.committed_generation()) + 1
+        dimension = source.shape[1]
+        with open(self.compacted_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, dimension, projection, generation))
+            batch = 4096
+            for i in range(0, len(live_offsets), batch):
+                offsets = live_offsets[i:i + batch]
+                rows = source[offsets]
+                if transform is not None:
+                    rows = transform(offsets, rows)
+                    dimension = rows.shape[1]
+                f.write(np.ascontiguousarray(rows, dtype='<f4').tobytes())
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, dimension, projection, generation))
+            f.flush()
+            os.fsync(f.fileno())
+        return remap
+
+    def commit_compacted(self, offsets):
+        """Commit ``offsets`` (``(embedding id, offset in the copy)`` pairs) and swap the copy in.
+
+        The offsets are committed with the copy's generation, so if the
+        process dies before the swap, :meth:`recover` can tell that the copy
+        is the layout the database refers to.
+        """
+        generation = self._read_header(self.compacted_path)[2]
+        with transaction.atomic():
+            Embedding.objects.bulk_update(
+                [Embedding(id=emb_id, vector_offset=offset) for emb_id, offset in offsets],
+                ['vector_offset'],
+                batch_size=500,
+            )
+            VectorSegmentState.objects.update_or_create(user_id=self.user_id, defaults={'generation': generation})
+        os.replace(self.compacted_path, self.path)
+
+    def recover(self):
+        """Settle a compacted copy left behind by a process that died before swapping it in.
+
+        The copy replaces the segment if its offsets were committed, and is
+        discarded otherwise. Runs whenever :attr:`lock` is taken.
+        """
+        if not self.compacted_path.exists():
+            return
+        try:
+            generation = self._read_header(self.compacted_path)[2]
+        except (OSError, ValueError):
+            generation = None
+        if generation is not None and generation == self.committed_generation():
+            os.replace(self.compacted_path, self.path)
+        else:
+            self.compacted_path.unlink(missing_ok=True)
+
+
+def load_vectors(segment, rows):
+    """Return a float32 matrix for ``rows`` (dicts with ``vector_offset`` and ``embedding``).
+
+    Rows still carrying a legacy pickled vector in the database are decoded
+    from it; the common case is a slice of the user's memory-mapped segment.
+    """
+    if all(row['vector_offset'] is not None for row in rows):
+        return segment.take([row['vector_offset'] for row in rows])
+
+    segment_vectors = segment.vectors()
+    return np.array([
+        segment_vectors[row['vector_offset']] if row['vector_offset'] is not None
+        else segment.project([pickle.loads(row['embedding'])])[0]
+        for row in rows
+    ], dtype='float32')
+
+
+def compact_user_vectors(user_id, force=False):
+    """Drop dead rows from a user's segment and move legacy pickled vectors into it.
+
+    Compaction only runs when the dead fraction exceeds
+    ``VECTOR_COMPACTION_DEAD_RATIO`` unless ``force`` is set. Returns the
+    number of rows reclaimed.
+    """
+    segment = VectorSegment(user_id)
+    with segment.lock:
+        embeddings = Embedding.objects.filter(document__owner_id=user_id)
+
+        legacy = list(embeddings.filter(vector_offset__isnull=True).exclude(embedding=None).only('id', 'embedding'))
+        if legacy:
+            offsets = segment.append([pickle.loads(emb.embedding) for emb in legacy])
+            for emb, offset in zip(legacy, offsets):
+                emb.vector_offset = offset
+                emb.embedding = None
+            Embedding.objects.bulk_update(legacy, ['vector_offset', 'embedding'], batch_size=500)
+
+        live = list(
+            embeddings.filter(vector_offset__isnull=False)
+            .order_by('vector_offset')
+            .values_list('id', 'vector_offset')
+        )
+        total = len(segment)
+        dead = total - len(live)
+        if not dead or (not force and dead / total < settings.VECTOR_COMPACTION_DEAD_RATIO):
+            return 0
+
+        remap = segment.write_compacted([offset for _, offset in live])
+        segment.commit_compacted([(emb_id, remap[offset]) for emb_id, offset in live])
+        return dead
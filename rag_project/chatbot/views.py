@@ -1,9 +1,20 @@
+import os
+from contextlib import ExitStack
+
 from django.urls import reverse
 import requests
 from rest_framework import viewsets, permissions, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import Throttled
 from rest_framework.response import Response
+from .admission import admitted
+from .events import publish, stream_session_events
+from .dispatch import enqueue_chat_response, enqueue_document_batches, enqueue_document_reindex
 from .models import Document, ChatSession, ChatMessage
 from .serializers import DocumentSerializer, ChatSessionSerializer, ChatMessageSerializer
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
@@ -13,17 +24,31 @@ from dateutil import parser
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
+from django.db import transaction
 from graphene_django.views import GraphQLView
+from graphene.validation import depth_limit_validator
+from graphql import specified_rules
 from rest_framework.authentication import TokenAuthentication
+from .loaders import RequestLoaders
+from .uploads import collect_uploads, plan_batches
+from .validation import complexity_limit_validator
 
 
 class DRFAuthGraphQLView(GraphQLView):
+    # graphql.validate() runs only these rules, so the standard ones must be listed too.
+    validation_rules = (
+        *specified_rules,
+        depth_limit_validator(max_depth=settings.GRAPHQL_MAX_DEPTH),
+        complexity_limit_validator(max_complexity=settings.GRAPHQL_MAX_COMPLEXITY),
+    )
+
     def get_context(self, request):
         user_auth_tuple = TokenAuthentication().authenticate(request)
         if user_auth_tuple:
             request.user, request.auth = user_auth_tuple
         else:
             request.user = None
+        request.loaders = RequestLoaders()
         return request
     
 class CustomAuthToken(ObtainAuthToken):
@@ -67,6 +92,64 @@ class DocumentViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk_upload(self, request):
+        """Upload many files, or zip archives of them, in one request.
+
+        All documents are created in one transaction and indexed by a group of
+        Celery tasks dispatched once it commits.
+        """
+        uploads = request.FILES.getlist('files')
+        if not uploads:
+            return Response({'detail': "No files were uploaded."}, status=status.HTTP_400_BAD_REQUEST)
+
+        with ExitStack() as stack:
+            files, skipped = collect_uploads(uploads, stack)
+            if not files:
+                return Response(
+                    {'detail': "None of the uploaded files are supported.", 'skipped': skipped},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if len(files) > settings.BULK_UPLOAD_MAX_FILES:
+                return Response(
+                    {'detail': f"At most {settings.BULK_UPLOAD_MAX_FILES} files can be uploaded at once."},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            documents = []
+            for file in files:
+                document = Document(
+                    owner=request.user,
+                    title=os.path.splitext(file.name)[0][:255],
+                    file=file
+                )
+                document.clean()
+                documents.append(document)
+
+            with transaction.atomic():
+                # bulk_create skips Document.save, so nothing is dispatched per file; storing
+                # each file takes its FileBlob reference.
+                Document.objects.bulk_create(documents)
+                sizes = [(document.id, file.size) for document, file in zip(documents, files)]
+                transaction.on_commit(lambda: enqueue_document_batches(plan_batches(sizes)))
+
+        serializer = self.get_serializer(documents, many=True)
+        return Response({'documents': serializer.data, 'skipped': skipped}, status=status.HTTP_201_CREATED)
+
+    def perform_update(self, serializer):
+        old_name = serializer.instance.file.name
+        document = serializer.save()
+        if 'file' not in serializer.validated_data:
+            return
+
+        # Document.save moved the reference to the new file; identical content maps to the same name.
+        if document.file.name == old_name:
+            return
+
+        # The old chunks keep serving queries until the new file is indexed. A document still
+        # being processed is reindexed too; its processing task drops the old file's chunks.
+        transaction.on_commit(lambda: enqueue_document_reindex(document.id))
+
     def destroy(self, request, *args, **kwargs):
      instance = self.get_object()
      if instance.owner != request.user:
@@ -109,12 +192,21 @@ class ChatMessageViewSet(viewsets.ModelViewSet):
             id=self.kwargs['session_pk'],
             user=self.request.user
         )
-     
-        message = serializer.save(session=session, is_user=True)
 
-        
-        from .tasks import generate_chat_response
-        generate_chat_response.delay(session.id, message.id)
+        # Refuse up front rather than queue answers nobody will wait for.
+        with admitted() as ticket:
+            if ticket is None:
+                raise Throttled(
+                    wait=settings.LLM_BUSY_RETRY_AFTER,
+                    detail="The assistant is busy answering other questions. Please try again shortly."
+                )
+
+            with transaction.atomic():
+                message = serializer.save(session=session, is_user=True)
+                # Lets other tabs open on this session show the question too; best effort,
+                # so a pub/sub failure cannot stop the answer from being queued.
+                transaction.on_commit(lambda: publish(session.id, 'message', message=serializer.data), robust=True)
+                transaction.on_commit(lambda: enqueue_chat_response(session.id, message.id, ticket))
 
     def create(self, request, *args, **kwargs):
         
@@ -126,6 +218,30 @@ class ChatMessageViewSet(viewsets.ModelViewSet):
 
 
  
+async def session_events(request, session_id):
+    """Stream a chat session's events (answer tokens, new messages) as server-sent events.
+
+    Needs an ASGI server such as uvicorn; under WSGI the stream would tie up a
+    worker thread, so the chat page falls back to polling instead.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'detail': "Chat events need an ASGI server."}, status=501)
+
+    user = await request.auser()
+    if not user.is_authenticated:
+        user_auth_tuple = await sync_to_async(TokenAuthentication().authenticate)(request)
+        if not user_auth_tuple:
+            return JsonResponse({'detail': "Authentication credentials were not provided."}, status=401)
+        user = user_auth_tuple[0]
+    if not await ChatSession.objects.filter(id=session_id, user=user).aexists():
+        raise Http404
+
+    response = StreamingHttpResponse(stream_session_events(session_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @login_required
 def chat_view(request, session_id):
     auth_token = request.user.auth_token.key
@@ -150,6 +266,7 @@ def chat_view(request, session_id):
         "session": session,
         "api_url": reverse('session-messages-list', args=[session_id]),
         "send_url": reverse('session-messages-list', args=[session_id]),
+        "events_url": reverse('session_events', args=[session_id]),
         "auth_token": auth_token
     })
 
@@ -181,6 +298,16 @@ def index(request):
                 )
 
        
+        elif request.POST.get("form_type") == "bulk_documents":
+            files = request.FILES.getlist("bulk_files")
+            if files:
+                requests.post(
+                    f"{settings.API_BASE_URL}/documents/bulk/",
+                    files=[("files", (file.name, file)) for file in files],
+                    headers=auth_header
+                )
+
+       
         elif "delete_session_id" in request.POST:
             session_id = request.POST.get("delete_session_id")
             if session_id:
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
+import json
 import os
 from dotenv import load_dotenv
 
@@ -87,6 +88,15 @@ DATABASES = {
         'NAME': BASE_DIR / 'db.sqlite3',
     }
 }
+if os.getenv('POSTGRES_DB'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.getenv('POSTGRES_DB'),
+        'USER': os.getenv('POSTGRES_USER', 'postgres'),
+        'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+        'HOST': os.getenv('POSTGRES_HOST', 'localhost'),
+        'PORT': os.getenv('POSTGRES_PORT', '5432'),
+    }
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
@@ -130,10 +140,35 @@ if not DEBUG:
 GRAPHENE = {
     'SCHEMA': 'rag_project.schema.schema'
 }
+GRAPHQL_MAX_DEPTH = int(os.getenv('GRAPHQL_MAX_DEPTH', '8'))
+# Every field costs 1 and each list level multiplies what is under it by 10. Selecting every field
+# on sessions -> messages -> references -> document -> embeddings costs ~52,500; one more list
+# level on top of that is rejected.
+GRAPHQL_MAX_COMPLEXITY = int(os.getenv('GRAPHQL_MAX_COMPLEXITY', '100000'))
 
 # Celery
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
+CELERY_BEAT_SCHEDULE = {
+    'compact-vector-segments': {
+        'task': 'chatbot.tasks.compact_vector_segments',
+        'schedule': float(os.getenv('VECTOR_COMPACTION_INTERVAL', 6 * 60 * 60)),
+    },
+}
+
+# LLM admission control: at most LLM_MAX_CONCURRENCY answers are generated at
+# once and LLM_MAX_QUEUE more may wait; beyond that new questions get a 429.
+REDIS_URL = os.getenv('REDIS_URL', CELERY_BROKER_URL)
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '2'))
+LLM_MAX_QUEUE = int(os.getenv('LLM_MAX_QUEUE', '20'))
+LLM_ADMISSION_TTL = int(os.getenv('LLM_ADMISSION_TTL', '300'))
+LLM_BUSY_RETRY_AFTER = int(os.getenv('LLM_BUSY_RETRY_AFTER', '5'))
+# Identical questions in flight share one answer, reused for LLM_COALESCE_RESULT_TTL seconds.
+LLM_COALESCE_TIMEOUT = int(os.getenv('LLM_COALESCE_TIMEOUT', '300'))
+LLM_COALESCE_RESULT_TTL = int(os.getenv('LLM_COALESCE_RESULT_TTL', '30'))
+
+# Seconds between keep-alive comments on an idle chat event stream.
+CHAT_EVENTS_KEEPALIVE = float(os.getenv('CHAT_EVENTS_KEEPALIVE', '15'))
 
 # Security headers
 SECURE_SSL_REDIRECT = os.getenv('SECURE_SSL_REDIRECT', 'False') == 'True'
@@ -156,6 +191,72 @@ API_BASE_URL = "http://localhost:8000/api"
 FAISS_INDEX_PATH = os.getenv('FAISS_INDEX_PATH', str(BASE_DIR / 'faiss_indices'))
 os.makedirs(FAISS_INDEX_PATH, exist_ok=True)
 
+# Compressed FAISS indexes: 'flat' (full precision), 'sq8' (int8), 'pq' (IVF-PQ) or 'auto' (by corpus size)
+VECTOR_QUANTIZATION = os.getenv('VECTOR_QUANTIZATION', 'auto')
+VECTOR_QUANTIZATION_USERS = json.loads(os.getenv('VECTOR_QUANTIZATION_USERS', '{}'))  # {"<user id>": "<mode>"}
+VECTOR_QUANTIZATION_SQ8_MIN = int(os.getenv('VECTOR_QUANTIZATION_SQ8_MIN', '100000'))
+VECTOR_QUANTIZATION_PQ_MIN = int(os.getenv('VECTOR_QUANTIZATION_PQ_MIN', '1000000'))
+VECTOR_PQ_M = int(os.getenv('VECTOR_PQ_M', '64'))  # bytes per vector in PQ mode
+VECTOR_RERANK_FACTOR = int(os.getenv('VECTOR_RERANK_FACTOR', '10'))  # candidates re-scored per result
+VECTOR_INDEX_NPROBE = int(os.getenv('VECTOR_INDEX_NPROBE', '32'))
+VECTOR_INDEX_MAX_LISTS = int(os.getenv('VECTOR_INDEX_MAX_LISTS', '16384'))
+VECTOR_INDEX_TRAIN_SAMPLE = int(os.getenv('VECTOR_INDEX_TRAIN_SAMPLE', '200000'))
+VECTOR_INDEX_MAX_DEAD_RATIO = float(os.getenv('VECTOR_INDEX_MAX_DEAD_RATIO', '0.2'))  # retrain past this
+VECTOR_INDEX_CACHE_SIZE = int(os.getenv('VECTOR_INDEX_CACHE_SIZE', '8'))  # indexes kept loaded per process
+
+# Retrieval backend: chatbot.retrieval.FaissBackend or chatbot.retrieval.PgVectorBackend (PostgreSQL only)
+RETRIEVAL_BACKEND = os.getenv('RETRIEVAL_BACKEND', 'chatbot.retrieval.FaissBackend')
+PGVECTOR_DIMENSIONS = int(os.getenv('PGVECTOR_DIMENSIONS', '4096'))  # mistral embedding width
+# HNSW indexes at most 2000 dimensions; wider vectors are indexed through a sketch this wide and re-ranked.
+# Both widths are fixed by migration 0005.
+PGVECTOR_INDEX_DIMENSIONS = int(os.getenv('PGVECTOR_INDEX_DIMENSIONS', '1024'))
+PGVECTOR_HNSW_M = int(os.getenv('PGVECTOR_HNSW_M', '16'))
+PGVECTOR_HNSW_EF_CONSTRUCTION = int(os.getenv('PGVECTOR_HNSW_EF_CONSTRUCTION', '64'))
+PGVECTOR_HNSW_EF_SEARCH = int(os.getenv('PGVECTOR_HNSW_EF_SEARCH', '40'))
+# pgvector >= 0.8 keeps scanning the HNSW graph until enough rows pass the owner filter
+PGVECTOR_ITERATIVE_SCAN = os.getenv('PGVECTOR_ITERATIVE_SCAN', 'relaxed_order')
+
+# Vector store: one append-only, memory-mapped segment file per user
+VECTOR_STORE_PATH = os.getenv('VECTOR_STORE_PATH', str(BASE_DIR / 'vector_store'))
+os.makedirs(VECTOR_STORE_PATH, exist_ok=True)
+# Segments are rewritten once this fraction of their rows belongs to deleted embeddings
+VECTOR_COMPACTION_DEAD_RATIO = float(os.getenv('VECTOR_COMPACTION_DEAD_RATIO', '0.25'))
+# Dimensionality reduction: new segments store embeddings projected with this trained
+# projection version (0 stores them unprojected); see `manage.py project_vectors`.
+VECTOR_PROJECTION_VERSION = int(os.getenv('VECTOR_PROJECTION_VERSION', '0'))
+VECTOR_PROJECTION_TRAIN_SAMPLE = int(os.getenv('VECTOR_PROJECTION_TRAIN_SAMPLE', '100000'))
+
+# Sharded retrieval (RETRIEVAL_BACKEND='chatbot.sharding.ShardedFaissBackend'): each user's
+# documents are spread over VECTOR_SHARDS shards, searched by workers consuming the
+# '<VECTOR_SHARD_QUEUE_PREFIX>-<n>' queues, for corpora of at least VECTOR_SHARD_MIN_VECTORS chunks.
+VECTOR_SHARDS = int(os.getenv('VECTOR_SHARDS', '1'))
+VECTOR_SHARD_QUEUE_PREFIX = os.getenv('VECTOR_SHARD_QUEUE_PREFIX', 'vector-shard')
+VECTOR_SHARD_MIN_VECTORS = int(os.getenv('VECTOR_SHARD_MIN_VECTORS', '0'))
+VECTOR_SHARD_IMBALANCE = float(os.getenv('VECTOR_SHARD_IMBALANCE', '0.1'))
+VECTOR_SHARD_SEARCH_TIMEOUT = float(os.getenv('VECTOR_SHARD_SEARCH_TIMEOUT', '30'))
+
+# PDF parsing: pages of PDFs with at least PDF_PARALLEL_MIN_PAGES pages are extracted by a process pool,
+# smaller PDFs by one process; PDF_PAGE_TIMEOUT=0 extracts in process with no per-page time limit
+PDF_PARSE_WORKERS = int(os.getenv('PDF_PARSE_WORKERS', os.cpu_count() or 1))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '8'))
+PDF_PAGE_TIMEOUT = float(os.getenv('PDF_PAGE_TIMEOUT', '30'))  # seconds before a page is skipped
+
 # File upload settings
+# Uploads are streamed to a temporary file and hashed on the way, never buffered in memory.
+FILE_UPLOAD_HANDLERS = ['chatbot.storage.HashingFileUploadHandler']
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
-DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
\ No newline at end of file
+DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
+
+# Bulk upload: at most BULK_UPLOAD_MAX_FILES documents per request (zip members included), adding up
+# to BULK_UPLOAD_MAX_BYTES uncompressed; larger files than BULK_UPLOAD_MAX_FILE_BYTES are skipped.
+# Files smaller than INGEST_BATCH_MAX_BYTES are indexed together, up to
+# INGEST_BATCH_MAX_DOCUMENTS per task.
+BULK_UPLOAD_MAX_FILES = int(os.getenv('BULK_UPLOAD_MAX_FILES', '500'))
+DATA_UPLOAD_MAX_NUMBER_FILES = BULK_UPLOAD_MAX_FILES
+BULK_UPLOAD_MAX_BYTES = int(os.getenv('BULK_UPLOAD_MAX_BYTES', 1024 * 1024 * 1024))
+BULK_UPLOAD_MAX_FILE_BYTES = int(os.getenv('BULK_UPLOAD_MAX_FILE_BYTES', 100 * 1024 * 1024))
+INGEST_BATCH_MAX_BYTES = int(os.getenv('INGEST_BATCH_MAX_BYTES', 2 * 1024 * 1024))
+INGEST_BATCH_MAX_DOCUMENTS = int(os.getenv('INGEST_BATCH_MAX_DOCUMENTS', '20'))
+# Tasks indexing the same document take turns through a Redis lock, which expires
+# DOCUMENT_INDEX_LOCK_TIMEOUT seconds after its holder dies.
+DOCUMENT_INDEX_LOCK_TIMEOUT = int(os.getenv('DOCUMENT_INDEX_LOCK_TIMEOUT', '3600'))
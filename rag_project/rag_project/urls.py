@@ -20,7 +20,7 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_nested.routers import NestedDefaultRouter
-from chatbot.views import DocumentViewSet, ChatSessionViewSet, ChatMessageViewSet, CustomAuthToken, login_view, chat_view, DRFAuthGraphQLView, index
+from chatbot.views import DocumentViewSet, ChatSessionViewSet, ChatMessageViewSet, CustomAuthToken, login_view, chat_view, DRFAuthGraphQLView, index, session_events
 from chatbot.schema import schema
 
 router = DefaultRouter()
@@ -34,6 +34,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include(router.urls)),
     path('api/', include(sessions_router.urls)),
+    path('api/chat-sessions/<int:session_id>/events/', session_events, name='session_events'),
     path('api-token-auth/', CustomAuthToken.as_view(), name='api_token_auth'),
     path('login/', login_view, name='login'),
     path('chat/<int:session_id>/', chat_view, name='chat_view'),